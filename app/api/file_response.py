@@ -0,0 +1,126 @@
+import re
+from collections.abc import Iterator
+from typing import Optional
+
+from fastapi import HTTPException, Request
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from starlette.responses import Response, StreamingResponse
+
+from app.utils.file_blob import iter_decompressed_chunks
+from app.utils.utils import transliteration
+
+FILE_CHUNK_SIZE = 1024 * 1024
+BLOB_CHUNK_SQL = "SELECT substring(body from :start for :length) FROM file_blob WHERE sha256 = :key"
+FILE_STORAGE_CHUNK_SQL = "SELECT substring(file_body from :start for :length) FROM file_storage WHERE id = :key"
+
+
+def get_file_storage_info(engine: Engine, file_storage_id: int) -> dict:
+    """Name, size, hash and place of the body of the file - the body itself is not read into python."""
+    with engine.connect() as connection:
+        result = connection.execute(
+            text(
+                "SELECT s.file_name, s.blob_sha256, b.compression, octet_length(b.body) AS stored_size, "
+                "coalesce(b.size, octet_length(s.file_body), 0) AS file_size, "
+                "coalesce(s.blob_sha256, md5(s.file_body)) AS file_hash "
+                "FROM file_storage s LEFT JOIN file_blob b ON b.sha256 = s.blob_sha256 "
+                "WHERE s.id = :file_storage_id"
+            ),
+            {"file_storage_id": file_storage_id},
+        ).first()
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"File with ID={file_storage_id} not found")
+    return dict(result._mapping)
+
+
+def iter_file_storage_body(
+    engine: Engine, info: dict, file_storage_id: int, start: int, end: int, chunk_size: int = FILE_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Yields the bytes [start, end] of the file by chunks (substring of bytea on the side of Postgres)."""
+    if info["compression"]:
+        # the compressed blob can not be sliced in DB - it is read by chunks and decompressed by stream,
+        # the bytes before start are decompressed and skipped
+        stored_chunks = _iter_bytea_chunks(engine, BLOB_CHUNK_SQL, info["blob_sha256"], 0, info["stored_size"] - 1)
+        yield from _slice_chunks(iter_decompressed_chunks(stored_chunks, info["compression"]), start, end)
+        return
+    if info["blob_sha256"]:
+        yield from _iter_bytea_chunks(engine, BLOB_CHUNK_SQL, info["blob_sha256"], start, end, chunk_size)
+    else:
+        yield from _iter_bytea_chunks(engine, FILE_STORAGE_CHUNK_SQL, file_storage_id, start, end, chunk_size)
+
+
+def _iter_bytea_chunks(
+    engine: Engine, sql: str, key, start: int, end: int, chunk_size: int = FILE_CHUNK_SIZE
+) -> Iterator[bytes]:
+    with engine.connect() as connection:
+        position = start
+        while position <= end:
+            length = min(chunk_size, end - position + 1)
+            chunk = connection.execute(text(sql), {"start": position + 1, "length": length, "key": key}).scalar()
+            yield bytes(chunk)
+            position += length
+
+
+def _slice_chunks(chunks: Iterator[bytes], start: int, end: int) -> Iterator[bytes]:
+    """The bytes [start, end] of the body given by chunks."""
+    position = 0
+    for chunk in chunks:
+        chunk_start, position = position, position + len(chunk)
+        if position <= start:
+            continue
+        yield chunk[max(start - chunk_start, 0) : end + 1 - chunk_start]
+        if position > end:
+            return
+
+
+def parse_range(range_header: str, file_size: int) -> Optional[tuple[int, int]]:
+    """
+    Returns (start, end) of "Range: bytes=start-end" (one range only; None - the whole file must be returned).
+    Raises 416 for a range out of the file.
+    """
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header or "")
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # the last N bytes
+        start, end = max(file_size - int(end), 0), file_size - 1
+    else:
+        start, end = int(start), min(int(end), file_size - 1) if end else file_size - 1
+    if start > end or start >= file_size:
+        raise HTTPException(
+            status_code=416, detail="Requested range not satisfiable", headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    return start, end
+
+
+def file_storage_response(request: Request, engine: Engine, file_storage_id: int, media_type: str) -> Response:
+    """StreamingResponse of the file from file_storage with the support of Range and If-None-Match (ETag)."""
+    info = get_file_storage_info(engine, file_storage_id)
+    file_size = info["file_size"]
+    headers = {
+        "Content-Disposition": f'attachment; filename="{transliteration(info["file_name"])}"',
+        "Access-Control-Expose-Headers": "Content-Disposition, Content-Range, ETag",
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{info["file_hash"]}"',
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if info["file_hash"] and headers["ETag"] in [el.strip() for el in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    byte_range = parse_range(request.headers.get("range"), file_size) if file_size else None
+    if request.headers.get("if-range") not in (None, headers["ETag"]):
+        byte_range = None  # the file was changed - the whole file is returned
+    status_code = 200
+    start, end = 0, file_size - 1
+    if byte_range:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file_storage_body(engine, info, file_storage_id, start, end),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+    )
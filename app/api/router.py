@@ -1,24 +1,38 @@
 import datetime
 import logging
+import os
+from tempfile import TemporaryDirectory
 from typing import Any, Optional
 
 import pandas as pd
-from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, Query, UploadFile
+from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, Query, Request, UploadFile
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 from sqlalchemy.util import asyncio
-from starlette.responses import StreamingResponse
-from tqdm import tqdm
+from starlette.responses import JSONResponse, StreamingResponse
 
 from app.api.deps import get_db, get_db_ora, get_engine, get_engine_ora
+from app.api.file_response import file_storage_response
 from app.auth.crud import check_token, write_user_history
-from app.core import crud, models, schemas
+from app.core import crud, schemas
 from app.core.crud import delete_mapping_client_cogmnos_sap, import_rps_from_ora
 from app.core.models import MappingClientCognosToSAP
 from app.settings import EXCEL_MEDIA_TYPE, PARSED_CONFIG, MyLogTypeEnum
-from app.utils.calc_tou import calc_tou
-from app.utils.load_cognos_sap import load_cognos_file, load_fact_from_pickle, load_sap_file
-from app.utils.utils import save_df_to_model_via_csv, transliteration
+from app.utils.calc_tou import (
+    RESULT_FILE_TYPES,
+    calc_tou,
+    get_calc_tou_result,
+    render_calc_tou_result_background,
+    reproject_calc_tou,
+)
+from app.utils.load_cognos_sap import (
+    load_cognos_file,
+    load_fact_files,
+    load_fact_from_pickle,
+    load_sap_file,
+    process_load_job_background,
+)
+from app.utils.utils import save_df_to_model_via_csv
 
 # to include app api use next line
 # from app.service_name.api.v1 import router as service_name_router
@@ -210,17 +224,14 @@ async def load_cognos_list(
 ) -> Any:
     loop = asyncio.get_running_loop()
     username = PARSED_CONFIG.username
-    result_all = []
-    for report in tqdm(files_list):
-        uploaded_file = report.file
-        # result = loop.run_until_complete(load_cognos_file(db, engine, engine_ora, uploaded_file, is_overwrite))
-        # result = await load_cognos_file(db, engine, engine_ora, uploaded_file, is_overwrite)
-        result = await asyncio.gather(
-            # loop.run_until_complete(load_cognos_file(db, engine, engine_ora, uploaded_file, is_overwrite))
-            loop.run_in_executor(None, load_cognos_file, db, engine, engine_ora, uploaded_file, is_overwrite),
+    with TemporaryDirectory() as spool_path:
+        # the uploads are spooled to disk - each process of the pool reads only its own file
+        files = await loop.run_in_executor(None, crud.spool_upload_files, files_list, spool_path)
+        # the files are parsed in parallel, the facts are saved in one step (see load_fact_files)
+        result_all = await loop.run_in_executor(
+            None, load_fact_files, db, engine, engine_ora, files, "Cognos", is_overwrite
         )
-        result_all.append(result)
-        crud.fact_fully_loaded_slow(db)  # for actualisation CalcTouLoaded
+    for report, result in zip(files_list, result_all):
         write_user_history(
             db=db,
             username=username,
@@ -253,24 +264,79 @@ async def load_sap_list(
     engine: Engine = Depends(get_engine),
     engine_ora: Engine = Depends(get_engine_ora),
 ) -> Any:
-    pass
-
     loop = asyncio.get_running_loop()
     username = PARSED_CONFIG.username
-    result_all = []
-    for report in tqdm(files_list):
-        uploaded_file = report.file
-        result = await asyncio.gather(
-            loop.run_in_executor(None, load_sap_file, db, engine, engine_ora, uploaded_file, is_overwrite),
+    with TemporaryDirectory() as spool_path:
+        files = await loop.run_in_executor(None, crud.spool_upload_files, files_list, spool_path)
+        result_all = await loop.run_in_executor(
+            None, load_fact_files, db, engine, engine_ora, files, "SAP", is_overwrite
         )
-        result_all.append(result)
-        crud.fact_fully_loaded_slow(db)  # for actualisation CalcTouLoaded
+    for report, result in zip(files_list, result_all):
         write_user_history(
             db=db, username=username, message=f'Called "load-sap-excel-list" from file="{report.filename}" ({result})'
         )
     return result_all
 
 
+@router.post(
+    "/load-job/",
+    response_model=schemas.LoadJob,
+    name="Queue the load of Fact from Cognos/SAP files (returns the job at once, the progress - GET load-job/{id})",
+)
+def load_job_create(
+    background_tasks: BackgroundTasks,
+    files_list: list[UploadFile],
+    load_from: str = Query("Cognos", description="The source of the files (Cognos, SAP)"),
+    is_overwrite: bool = True,
+    db: Session = Depends(get_db),
+    engine: Engine = Depends(get_engine),
+    engine_ora: Engine = Depends(get_engine_ora),
+):
+    username = PARSED_CONFIG.username
+    db_load_job = crud.create_load_job(db, load_from, files_list, is_overwrite, username)
+    if not PARSED_CONFIG.LOAD_JOB_QUEUE:
+        crud.claim_load_job(db, f"{crud.LOAD_JOB_API_WORKER_PREFIX}{os.getpid()}", db_load_job.id)
+        background_tasks.add_task(process_load_job_background, engine, engine_ora, db_load_job.id)
+    write_user_history(
+        db=db,
+        username=username,
+        message=f'Called "load-job" (ID={db_load_job.id}, {load_from}, files={[el.filename for el in files_list]})',
+    )
+    return crud.get_load_job(db, db_load_job.id)
+
+
+@router.put(
+    "/load-job/{load_job_id}/retry",
+    response_model=schemas.LoadJob,
+    name="Repeat the failed load job (by its spooled files)",
+)
+def load_job_retry(
+    load_job_id: int,
+    background_tasks: BackgroundTasks,
+    db: Session = Depends(get_db),
+    engine: Engine = Depends(get_engine),
+    engine_ora: Engine = Depends(get_engine_ora),
+):
+    crud.retry_load_job(db, load_job_id)
+    if not PARSED_CONFIG.LOAD_JOB_QUEUE:
+        crud.claim_load_job(db, f"{crud.LOAD_JOB_API_WORKER_PREFIX}{os.getpid()}", load_job_id)
+        background_tasks.add_task(process_load_job_background, engine, engine_ora, load_job_id)
+    write_user_history(db=db, username=PARSED_CONFIG.username, message=f'Called "load-job-retry" (ID={load_job_id})')
+    return crud.get_load_job(db, load_job_id)
+
+
+@router.get("/load-job/", response_model=list[schemas.LoadJob])
+def read_load_job_list(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    return crud.get_load_job_list(db, skip=skip, limit=limit)
+
+
+@router.get(
+    "/load-job/{load_job_id}", response_model=schemas.LoadJob, name="Get the status and progress of the load job"
+)
+def read_load_job(load_job_id: int, db: Session = Depends(get_db)):
+    return crud.get_load_job(db, load_job_id)
+
+
 @router.get(
     "/fact-fully-loaded/",
     name="Get a list of months with years in which the Fact has already been fully loaded (all days of the month)",
@@ -279,9 +345,23 @@ def fact_fully_loaded(db: Session = Depends(get_db), year_from: int = 1990, year
     return crud.fact_fully_loaded(db, year_from, year_to)
 
 
+@router.get(
+    "/fact-coverage-gaps/",
+    response_model=schemas.FactCoverageGaps,
+    name="Get the days of the period without the Fact (by sources) - the check before the start of calc TOU",
+)
+def fact_coverage_gaps(
+    date_from: datetime.date,
+    date_to: datetime.date,
+    load_from: Optional[list[str]] = Query(None, description="The sources required on each day (Cognos, SAP)"),
+    db: Session = Depends(get_db),
+):
+    return crud.get_fact_coverage_gaps(db, date_from, date_to, load_from)
+
+
 @router.get(
     "/fact-fully-loaded-slow/",
-    name="Get a list of months with years in which the Fact has already been fully loaded (all days of the month)",
+    name="Recount the coverage of the Fact by the full scan and get a list of fully loaded months with years",
 )
 def fact_fully_loaded_slow(db: Session = Depends(get_db), year_from: int = 1990, year_to: int = 2100):
     return crud.fact_fully_loaded_slow(db, year_from, year_to)
@@ -591,13 +671,37 @@ def calc_tou_start(
     engine_ora: Engine = Depends(get_engine_ora),
 ):
     username = PARSED_CONFIG.username
-    crud.check_calc_tou_can_start(db, calc_tou_id)
-    background_tasks.add_task(calc_tou, db, engine, engine_ora, calc_tou_id, username)
-    message = "The calculation of the TOU has started in the background"
+    if PARSED_CONFIG.CALC_TOU_QUEUE:
+        crud.enqueue_calc_tou(db, calc_tou_id, username)
+        message = "The calculation of the TOU has been queued (it will be started by the calculation worker)"
+    else:
+        crud.check_calc_tou_can_start(db, calc_tou_id)
+        background_tasks.add_task(calc_tou, db, engine, engine_ora, calc_tou_id, username)
+        message = "The calculation of the TOU has started in the background"
     write_user_history(db=db, username=username, message=f'Called "calc-tou-start" ({message})')
     return {"message": message}
 
 
+@router.put(
+    "/calc-tou-reproject/{calc_tou_id}",
+    name="Rebuild the result of the finished calc_tou by new base year/periods/seasonal coefficients (without fact).",
+)
+def calc_tou_reproject(
+    calc_tou_id: int,
+    base_year: Optional[int] = None,
+    amount_year_period: Optional[int] = None,
+    seasonal_coefficient_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    engine: Engine = Depends(get_engine),
+):
+    username = PARSED_CONFIG.username
+    result = reproject_calc_tou(
+        db, engine, calc_tou_id, username, base_year, amount_year_period, seasonal_coefficient_id
+    )
+    write_user_history(db=db, username=username, message=f'Called "calc-tou-reproject" ({result["message"]})')
+    return result
+
+
 @router.post("/calc-tou-external/", response_model=schemas.CalcTouExternal)
 async def calc_tou_external_create(
     calc_tou_external: schemas.CalcTouExternalCreate = Depends(),
@@ -660,24 +764,42 @@ async def load_file_in_db(
 ):
     # temp = NamedTemporaryFile(delete=False)     # temp.name - full file_name
     content = await uploaded_file.read()  # async read
-    db_file_storage = models.FileStorage(
-        file_name=uploaded_file.filename,
-        file_body=content,
-    )
-    db.add(db_file_storage)
+    db_file_storage = crud.create_file_storage(db, uploaded_file.filename, content)
     db.commit()
     return db_file_storage
     # return {"Result": "OK"}
 
 
 @router.get("/download-file-from-db/{file_storage_id}")
-async def download_file_from_db(file_storage_id: int, db: Session = Depends(get_db)):
-    file_storage = db.query(models.FileStorage).filter(models.FileStorage.id == file_storage_id).first()
-    response = StreamingResponse(iter([file_storage.file_body]), media_type=EXCEL_MEDIA_TYPE)
-    file_name = transliteration(file_storage.file_name)
-    response.headers["Content-Disposition"] = f'attachment; filename="{file_name}"'
-    response.headers["Access-Control-Expose-Headers"] = "Content-Disposition"
-    return response
+def download_file_from_db(file_storage_id: int, request: Request, engine: Engine = Depends(get_engine)):
+    # the body is streamed from DB by chunks (Range and If-None-Match are supported)
+    return file_storage_response(request, engine, file_storage_id, EXCEL_MEDIA_TYPE)
+
+
+@router.post("/file-storage-gc/", name="Delete the bodies of files which are not referenced by file_storage")
+def file_storage_gc(db: Session = Depends(get_db)):
+    return {"Result": "OK", "deleted": crud.collect_file_blob_garbage(db)}
+
+
+@router.get("/calc-tou-result/{calc_tou_id}", name="Download the result of calc_tou (xlsx, csv or parquet)")
+def download_calc_tou_result(
+    calc_tou_id: int,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    file_type: str = "xlsx",
+    db: Session = Depends(get_db),
+    engine: Engine = Depends(get_engine),
+):
+    db_file_storage = get_calc_tou_result(db, calc_tou_id, file_type)
+    if db_file_storage is None:
+        # the first download of the format - the render of the big result takes minutes, it is done on background
+        background_tasks.add_task(render_calc_tou_result_background, calc_tou_id, file_type)
+        return JSONResponse(
+            status_code=202,
+            content={"message": f"The result is being rendered to {file_type}, repeat the request later"},
+            headers={"Retry-After": "60"},
+        )
+    return file_storage_response(request, engine, db_file_storage.id, RESULT_FILE_TYPES[file_type])
 
 
 @router.get("/log-list/", response_model=list[schemas.Log])
@@ -1,13 +1,16 @@
 import datetime
-from calendar import monthrange
+import os
+import shutil
+from collections.abc import Iterable
+from tempfile import TemporaryFile
 from time import sleep
-from typing import Optional
+from typing import Optional, Union
 
 import pandas as pd
 from fastapi import HTTPException, UploadFile
 from pandas import DataFrame
 from psycopg2 import Date
-from sqlalchemy import and_, select
+from sqlalchemy import and_, select, text
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
@@ -20,10 +23,21 @@ from ..settings import (
     AmountOperationEnum,
     CalcStateEnum,
     CalcTypeMergeEnum,
+    LoadJobStateEnum,
     MyLogTypeEnum,
 )
+from ..utils.calc_cache import invalidate_calc_cache
+from ..utils.fact_partition import overwrite_fact_partitions
+from ..utils.file_blob import (
+    compress_file_body,
+    compress_file_stream,
+    decompress_file_body,
+    file_body_hash,
+    spool_file_body,
+)
 from ..utils.utils import get_info_from_excel, table_writer
 from ..utils.utils_df import MAPPING_SEASONAL_COEFFICIENT, MAPPING_SEASONAL_COEFFICIENT_REVERSE
+from ..utils.utils_os import OsCls
 from . import models, schemas
 from .schemas import SeasonCoefficientBodyCreate, SeasonCoefficientCreate
 
@@ -166,17 +180,292 @@ def check_calc_tou_can_start(db: Session, calc_tou_id: int):
             detail=f"The attempt to calculate the TOU was rejected "
             f"(status = {db_calc_tou.status.value}, but need {CalcStateEnum.new.value})",
         )
+    coverage = get_fact_coverage_gaps(db, db_calc_tou.date_from, db_calc_tou.date_to)
+    if not coverage["is_complete"]:
+        missing_days = coverage["missing_days"]
+        raise HTTPException(
+            status_code=422,
+            detail=f"To calculate the TOU, you need a fact for {coverage['days']} days, "
+            f"and there is only {coverage['days'] - len(missing_days)} "
+            f"(period {db_calc_tou.date_from} - {db_calc_tou.date_to}, missing: "
+            f"{', '.join(map(str, missing_days[:10]))}{' ...' if len(missing_days) > 10 else ''})",
+        )
+
+
+def get_fact_coverage_gaps(
+    db: Session, date_from: datetime.date, date_to: datetime.date, load_from_list: Optional[list[str]] = None
+) -> dict:
+    """
+    The days of [date_from, date_to] without the fact - by one lookup of fact_coverage (PK date_rep, load_from).
+    load_from_list - the sources which are required on each day (None - any source is enough),
+    missing_by_source - the days without the fact of each source (for information).
+    """
+    if date_from > date_to:
+        raise HTTPException(status_code=422, detail=f"date_from ({date_from}) is greater than date_to ({date_to})")
     result = db.execute(
-        f"SELECT COUNT(distinct(date_rep)) FROM fact "
-        f"where date_rep between '{db_calc_tou.date_from}' and '{db_calc_tou.date_to}'"
-    ).first()[0]
-    days = (db_calc_tou.date_to - db_calc_tou.date_from).days + 1
-    if int(result) != days:
+        f"SELECT day_::date AS date_rep, array_remove(array_agg(c.load_from), NULL) AS load_from_list "
+        f"FROM generate_series('{date_from}'::date, '{date_to}'::date, interval '1 day') AS day_ "
+        f"LEFT JOIN fact_coverage c ON c.date_rep = day_::date AND c.row_count > 0 "
+        f"GROUP BY day_ ORDER BY day_"
+    ).fetchall()
+    sources = sorted({"Cognos", "SAP"}.union(*[el["load_from_list"] for el in result]))
+    missing_by_source = {
+        load_from: [el["date_rep"] for el in result if load_from not in el["load_from_list"]] for load_from in sources
+    }
+    if load_from_list:
+        missing_days = [el["date_rep"] for el in result if not set(load_from_list) <= set(el["load_from_list"])]
+    else:
+        missing_days = [el["date_rep"] for el in result if not el["load_from_list"]]
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "days": len(result),
+        "is_complete": not missing_days,
+        "missing_days": missing_days,
+        "missing_by_source": missing_by_source,
+    }
+
+
+def enqueue_calc_tou(db: Session, calc_tou_id: int, username: str = ""):
+    check_calc_tou_can_start(db, calc_tou_id)
+    db_queue = (
+        db.query(models.CalcTouQueue)
+        .filter(models.CalcTouQueue.calc_tou_id == calc_tou_id, models.CalcTouQueue.date_finish.is_(None))
+        .first()
+    )
+    if db_queue:
         raise HTTPException(
             status_code=422,
-            detail=f"To calculate the TOU, you need a fact for {days} days, and there is only {result} "
-            f"(period {db_calc_tou.date_from} - {db_calc_tou.date_to})",
+            detail=f"The calculation of the TOU (ID={calc_tou_id}) is already in the queue (since {db_queue.date_queued})",
+        )
+    db_queue = models.CalcTouQueue(calc_tou_id=calc_tou_id, username=username or PARSED_CONFIG.username)
+    db.add(db_queue)
+    db.commit()
+    db.refresh(db_queue)
+    return db_queue
+
+
+def claim_queue_job(db: Session, model, worker: str, job_id: Optional[int] = None):
+    """
+    Takes the first free job of the queue table model (CalcTouQueue, LoadJob - the columns worker, attempt,
+    date_start, date_heartbeat, date_finish), job_id - only this job.
+    """
+    # "skip locked" - several workers (on several nodes) never take the same job
+    query = db.query(model).filter(model.date_start.is_(None))
+    if job_id:
+        query = query.filter(model.id == job_id)
+    db_job = query.order_by(model.id).with_for_update(skip_locked=True).first()
+    if db_job:
+        now = datetime.datetime.now()
+        db_job.worker = worker
+        db_job.attempt = (db_job.attempt or 0) + 1
+        db_job.date_start = now
+        db_job.date_heartbeat = now
+    db.commit()
+    return db_job
+
+
+def heartbeat_queue_jobs(db: Session, model, job_id_list: list[int]):
+    if job_id_list:
+        db.query(model).filter(model.id.in_(job_id_list)).update(
+            {"date_heartbeat": datetime.datetime.now()}, synchronize_session=False
         )
+        db.commit()
+
+
+def get_stale_queue_jobs(db: Session, model, timeout_sec: int) -> list:
+    """The started jobs without heartbeat for timeout_sec (their workers are dead), locked till the commit."""
+    date_stale = datetime.datetime.now() - datetime.timedelta(seconds=timeout_sec)
+    return (
+        db.query(model)
+        .filter(model.date_start.is_not(None), model.date_finish.is_(None), model.date_heartbeat < date_stale)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+
+def release_queue_job(db_job, max_attempt: int) -> bool:
+    """Returns the stale job to the queue (True) or closes it if max_attempt attempts are spent (False)."""
+    if db_job.attempt < max_attempt:
+        db_job.worker, db_job.date_start, db_job.date_heartbeat = None, None, None
+        return True
+    db_job.date_finish = datetime.datetime.now()
+    return False
+
+
+def claim_calc_tou_queue(db: Session, worker: str):
+    return claim_queue_job(db, models.CalcTouQueue, worker)
+
+
+def heartbeat_calc_tou_queue(db: Session, queue_id_list: list[int]):
+    heartbeat_queue_jobs(db, models.CalcTouQueue, queue_id_list)
+
+
+def finish_calc_tou_queue(db: Session, queue_id: int, exitcode: int = 0):
+    db_queue = db.query(models.CalcTouQueue).filter(models.CalcTouQueue.id == queue_id).first()
+    db_queue.date_finish = datetime.datetime.now()
+    db_calc_tou = db.query(models.CalcTOU).filter(models.CalcTOU.id == db_queue.calc_tou_id).first()
+    if exitcode and db_calc_tou and db_calc_tou.status == CalcStateEnum.in_process:
+        # the calculation is broken - it can be started again
+        db_calc_tou.status = CalcStateEnum.new
+        write_log(
+            db=db,
+            parent_id=db_queue.calc_tou_id,
+            parent_name="calc_tou",
+            type=MyLogTypeEnum.ERROR,
+            msg=f"The calculation was interrupted (worker {db_queue.worker}, exit code {exitcode})",
+            username=db_queue.username,
+        )
+    db.commit()
+
+
+def recover_stale_calc_tou_queue(db: Session, timeout_sec: int, max_attempt: int):
+    """The jobs of the dead workers (no heartbeat for timeout_sec) are returned to the queue or closed."""
+    db_queue_list = get_stale_queue_jobs(db, models.CalcTouQueue, timeout_sec)
+    for db_queue in db_queue_list:
+        db.query(models.CalcTOU).filter(
+            models.CalcTOU.id == db_queue.calc_tou_id, models.CalcTOU.status == CalcStateEnum.in_process
+        ).update({"status": CalcStateEnum.new}, synchronize_session=False)
+        release_queue_job(db_queue, max_attempt)
+        print(f"calc_tou_queue: recovered stale job {db_queue.id} (calc_tou_id={db_queue.calc_tou_id})")
+    db.commit()
+    return len(db_queue_list)
+
+
+LOAD_JOB_ROW_STAGES = {"parsed": "rows_parsed", "enriched": "rows_enriched", "copied": "rows_copied"}
+LOAD_JOB_API_WORKER_PREFIX = "api:"  # the jobs executed in the background of API (LOAD_JOB_QUEUE=False)
+
+
+def get_load_job_spool_path(load_job_id: int):
+    spool_path = PARSED_CONFIG.LOAD_JOB_SPOOL_DIR or OsCls.get_import_path("load_job")
+    return os.path.join(spool_path, str(load_job_id))
+
+
+def create_load_job(db: Session, load_from: str, files_list: list[UploadFile], is_overwrite=True, username: str = ""):
+    """The uploaded files are copied into the spool directory of the job (by chunks, not into memory)."""
+    if load_from not in ("Cognos", "SAP"):
+        raise HTTPException(status_code=422, detail=f"Unknown source of Fact ({load_from}), expected Cognos or SAP")
+    db_load_job = models.LoadJob(
+        load_from=load_from, is_overwrite=is_overwrite, username=username or PARSED_CONFIG.username
+    )
+    db.add(db_load_job)
+    db.flush()
+    spool_path = get_load_job_spool_path(db_load_job.id)
+    os.makedirs(spool_path, exist_ok=True)
+    for file_name, file_path in spool_upload_files(files_list, spool_path):
+        db.add(models.LoadJobFile(load_job_id=db_load_job.id, file_name=file_name, file_path=file_path))
+    db.commit()
+    db.refresh(db_load_job)
+    return db_load_job
+
+
+def spool_upload_files(files_list: list[UploadFile], spool_path: str) -> list[tuple[str, str]]:
+    """Copies the uploaded files into spool_path by chunks (not into memory), returns [(file name, file path)]."""
+    files = []
+    for num, uploaded_file in enumerate(files_list):
+        file_path = os.path.join(spool_path, f"{num:03d}_{os.path.basename(uploaded_file.filename)}")
+        with open(file_path, "wb") as spool_file:
+            shutil.copyfileobj(uploaded_file.file, spool_file, 1024 * 1024)
+        files.append((uploaded_file.filename, file_path))
+    return files
+
+
+def get_load_job(db: Session, load_job_id: int):
+    result = db.query(models.LoadJob).filter(models.LoadJob.id == load_job_id).first()
+    if result is None:
+        raise HTTPException(status_code=404, detail=f"LoadJob with ID={load_job_id} not found")
+    log = get_log(db=db, parent_id=load_job_id, parent_name="load_job")
+    result.log = log.msg if log else ""
+    return result
+
+
+def get_load_job_list(db: Session, skip: int = 0, limit: int = 100):
+    return db.query(models.LoadJob).order_by(models.LoadJob.id.desc()).offset(skip).limit(limit).all()
+
+
+def claim_load_job(db: Session, worker: str, load_job_id: int = None):
+    return claim_queue_job(db, models.LoadJob, worker, load_job_id)
+
+
+def heartbeat_load_job(db: Session, load_job_id_list: list[int]):
+    heartbeat_queue_jobs(db, models.LoadJob, load_job_id_list)
+
+
+def update_load_job_file(db: Session, load_job_file_id: int, stage: str, rows: int = None):
+    """
+    Writes the stage of the file, the rows of the finished stage and its speed
+    (the rows / the time since the previous stage of this file).
+    """
+    now = datetime.datetime.now()
+    db_file = db.query(models.LoadJobFile).filter(models.LoadJobFile.id == load_job_file_id).first()
+    if rows is not None and stage in LOAD_JOB_ROW_STAGES:
+        seconds = (now - (db_file.date_update or now)).total_seconds()
+        setattr(db_file, LOAD_JOB_ROW_STAGES[stage], rows)
+        db_file.rows_per_sec = round(rows / seconds, 1) if seconds > 0 else None
+    db_file.stage = stage
+    db_file.date_start = db_file.date_start or now
+    db_file.date_update = now
+    db.query(models.LoadJob).filter(models.LoadJob.id == db_file.load_job_id).update(
+        {"date_heartbeat": now}, synchronize_session=False
+    )
+    db.commit()
+
+
+def set_load_job_status(db: Session, load_job_id: int, status: LoadJobStateEnum):
+    db.query(models.LoadJob).filter(models.LoadJob.id == load_job_id).update(
+        {"status": status}, synchronize_session=False
+    )
+    db.commit()
+
+
+def finish_load_job(db: Session, load_job_id: int, exitcode: int = 0):
+    db_load_job = db.query(models.LoadJob).filter(models.LoadJob.id == load_job_id).first()
+    db_load_job.date_finish = datetime.datetime.now()
+    if exitcode and db_load_job.status in (LoadJobStateEnum.new, LoadJobStateEnum.in_process):
+        db_load_job.status = LoadJobStateEnum.error
+        write_log(
+            db=db,
+            parent_id=load_job_id,
+            parent_name="load_job",
+            type=MyLogTypeEnum.ERROR,
+            msg=f"The load was interrupted (worker {db_load_job.worker}, exit code {exitcode})",
+            username=db_load_job.username,
+        )
+    db.commit()
+
+
+def recover_stale_load_job(db: Session, timeout_sec: int, max_attempt: int):
+    """The jobs of the dead workers (no heartbeat for timeout_sec) are returned to the queue or closed."""
+    db_load_job_list = get_stale_queue_jobs(db, models.LoadJob, timeout_sec)
+    for db_load_job in db_load_job_list:
+        # the job of the dead API process is closed - no worker may take the load jobs (see retry_load_job)
+        is_api = (db_load_job.worker or "").startswith(LOAD_JOB_API_WORKER_PREFIX)
+        is_queued = release_queue_job(db_load_job, 0 if is_api else max_attempt)
+        db_load_job.status = LoadJobStateEnum.new if is_queued else LoadJobStateEnum.error
+        print(f"load_job: recovered stale job {db_load_job.id}")
+    db.commit()
+    return len(db_load_job_list)
+
+
+def retry_load_job(db: Session, load_job_id: int):
+    """Returns the failed job to the queue - its spooled files are kept after the failure."""
+    db_load_job = get_load_job(db, load_job_id)
+    if db_load_job.status != LoadJobStateEnum.error or db_load_job.date_finish is None:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Only the failed load job can be repeated (status = {db_load_job.status.value})",
+        )
+    if not all(os.path.isfile(db_file.file_path) for db_file in db_load_job.file_list):
+        raise HTTPException(status_code=422, detail=f"The files of the load job (ID={load_job_id}) are deleted")
+    db_load_job.status = LoadJobStateEnum.new
+    db_load_job.attempt = 0
+    db_load_job.worker, db_load_job.date_start, db_load_job.date_heartbeat = None, None, None
+    db_load_job.date_finish = None
+    for db_file in db_load_job.file_list:
+        db_file.stage, db_file.date_start, db_file.date_update = "queued", None, None
+        db_file.rows_parsed, db_file.rows_enriched, db_file.rows_copied, db_file.rows_per_sec = None, None, None, None
+    db.commit()
+    return db_load_job
 
 
 def fact_fully_loaded_slow_background(interval_sec: int):
@@ -189,29 +478,72 @@ def fact_fully_loaded_slow_background(interval_sec: int):
         # perform the task
 
 
-def fact_fully_loaded_slow(db: Session, year_from: int = 1990, year_to: int = 2100):
-    result = db.execute(
-        f"SELECT count(distinct(date_rep)), date_part('month', date_rep) as month_,  "
-        f"date_part('year', date_rep) as year_ "
-        f"FROM fact where date_rep between '{year_from}-01-01' and '{year_to}-12-31' group by year_, month_"
-    ).fetchall()
-    result = [
-        (el["year_"], el["month_"])
-        for el in result
-        if el["count"] == monthrange(int(el["year_"]), int(el["month_"]))[1]
-    ]
-    db.execute("TRUNCATE calc_tou_loaded RESTART IDENTITY;")
-    # db.query(models.CalcTouLoaded).delete(synchronize_session="fetch")
-    db.commit()
-    for el in result:
-        record = models.CalcTouLoaded(**{"year": el[0], "month": el[1]})
-        db.add(record)
+def update_fact_coverage(db: Session, date_min: Date, date_max: Date):
+    """
+    Recounts fact_coverage (rows by day and load_from) for the dates [date_min, date_max] only
+    and refreshes calc_tou_loaded for their months. Is called after every change of the fact.
+    """
+    if pd.isnull(date_min) or pd.isnull(date_max):
+        return
+    db.execute(
+        f"INSERT INTO fact_coverage (date_rep, load_from, row_count, date_update) "
+        f"SELECT date_rep, load_from, count(*), now() FROM fact "
+        f"WHERE date_rep BETWEEN '{date_min}'::date AND '{date_max}'::date GROUP BY date_rep, load_from "
+        f"ON CONFLICT (date_rep, load_from) DO UPDATE "
+        f"SET row_count = EXCLUDED.row_count, date_update = EXCLUDED.date_update"
+    )
+    # the days (sources) without rows in fact now - not updated by this transaction (now() is its start)
+    db.execute(
+        f"DELETE FROM fact_coverage WHERE date_rep BETWEEN '{date_min}'::date AND '{date_max}'::date "
+        f"AND date_update < now()::timestamp"
+    )
+    month_from = f"date_trunc('month', '{date_min}'::date)::date"
+    month_to = f"(date_trunc('month', '{date_max}'::date) + interval '1 month - 1 day')::date"
+    db.execute(f"DELETE FROM calc_tou_loaded WHERE make_date(year, month, 1) BETWEEN {month_from} AND {month_to}")
+    db.execute(
+        f"INSERT INTO calc_tou_loaded (year, month) "
+        f"SELECT date_part('year', month_), date_part('month', month_) FROM ("
+        f"  SELECT date_trunc('month', date_rep) AS month_, count(distinct(date_rep)) AS days FROM fact_coverage "
+        f"  WHERE date_rep BETWEEN {month_from} AND {month_to} AND row_count > 0 GROUP BY month_"
+        f") AS coverage "
+        f"WHERE days = date_part('day', month_ + interval '1 month - 1 day') ORDER BY month_"
+    )
     db.commit()
-    return result
+
+
+def backfill_fact_coverage(db: Session) -> bool:
+    """
+    Fills fact_coverage by the full scan of fact if it is empty while fact is not (the database was created
+    before fact_coverage), returns True if it was filled.
+    Only one process scans fact (every gunicorn worker calls it at startup), the others skip the backfill.
+    """
+    if not db.execute(text("SELECT pg_try_advisory_xact_lock(hashtext('fact_coverage_backfill'))")).scalar():
+        print("fact_coverage is being filled by another process")
+        return False
+    if db.execute("SELECT 1 FROM fact_coverage LIMIT 1").first():
+        return False
+    date_min, date_max = db.execute("SELECT min(date_rep), max(date_rep) FROM fact").first()
+    if date_min is None:
+        return False
+    print(f"Filling fact_coverage by fact ({date_min} - {date_max})...")
+    update_fact_coverage(db, date_min, date_max)
+    print("fact_coverage is filled")
+    return True
+
+
+def fact_fully_loaded_slow(db: Session, year_from: int = 1990, year_to: int = 2100):
+    """Reconciliation - fact_coverage and calc_tou_loaded are recounted by the full scan of fact for the years."""
+    update_fact_coverage(db, f"{year_from}-01-01", f"{year_to}-12-31")
+    return fact_fully_loaded(db, year_from, year_to)
 
 
 def fact_fully_loaded(db: Session, year_from: int = 2000, year_to: int = 2100):
-    result = db.query(models.CalcTouLoaded).filter(models.CalcTouLoaded.year.between(year_from, year_to)).all()
+    result = (
+        db.query(models.CalcTouLoaded)
+        .filter(models.CalcTouLoaded.year.between(year_from, year_to))
+        .order_by(models.CalcTouLoaded.year, models.CalcTouLoaded.month)
+        .all()
+    )
     return [(el.year, el.month) for el in result]
 
 
@@ -308,18 +640,33 @@ def get_facts(
 
 
 def delete_facts(db: Session, date_min: Date, date_max: Date, load_from: str):
-    amount_del_rec = (
-        db.query(models.Fact)
-        .filter(models.Fact.load_from == load_from, models.Fact.date_rep.between(date_min, date_max))
-        .delete(synchronize_session="fetch")
-    )
+    amount_del_rec = overwrite_fact_partitions(db, date_min, date_max, load_from)
     # delete_from_table_cmd = f"delete from fact where date_rep >= '{date_min}' " \
     #                         f"and date_rep <= '{date_max}' and load_from = 'Cognos';"
     # db.execute(delete_from_table_cmd)
     db.commit()
+    touch_fact_months(db, date_min, date_max)
     return {"message": f"removed {amount_del_rec} records"}
 
 
+def touch_fact_months(db: Session, date_min: Date, date_max: Date):
+    """
+    Increases the version of the fact months [date_min, date_max] - the cached calculations become stale,
+    the coverage of the dates is recounted.
+    """
+    if pd.isnull(date_min) or pd.isnull(date_max):
+        return
+    db.execute(
+        f"INSERT INTO fact_month_version (month, version, date_update) "
+        f"SELECT month::date, 1, now() FROM generate_series("
+        f"date_trunc('month', '{date_min}'::date), '{date_max}'::date, interval '1 month') AS month "
+        f"ON CONFLICT (month) DO UPDATE SET version = fact_month_version.version + 1, date_update = now()"
+    )
+    db.commit()
+    invalidate_calc_cache(date_min, date_max)
+    update_fact_coverage(db, date_min, date_max)
+
+
 def get_mapping_client_cogmnos_sap(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.MappingClientCognosToSAP).offset(skip).limit(limit).all()
 
@@ -414,6 +761,255 @@ def copy_calc_tou(
     )
 
 
+def acquire_file_blob(db: Session, file_body: bytes) -> str:
+    """Adds one reference to the blob of file_body (the blob is inserted if it is new), returns its sha256."""
+    sha256 = file_body_hash(file_body)
+    is_exist = db.execute(
+        text("UPDATE file_blob SET ref_count = ref_count + 1 WHERE sha256 = :sha256"), {"sha256": sha256}
+    ).rowcount
+    if not is_exist:
+        stored_body, compression = compress_file_body(file_body)
+        # ON CONFLICT - the same body is inserted by the parallel transaction
+        db.execute(
+            text(
+                "INSERT INTO file_blob (sha256, compression, size, ref_count, body) "
+                "VALUES (:sha256, :compression, :size, 1, :body) "
+                "ON CONFLICT (sha256) DO UPDATE SET ref_count = file_blob.ref_count + 1"
+            ),
+            {"sha256": sha256, "compression": compression, "size": len(file_body), "body": stored_body},
+        )
+    return sha256
+
+
+def acquire_file_blob_by_chunks(db: Session, chunks: Iterable[bytes], chunk_size: int = 1024 * 1024) -> str:
+    """
+    The same as acquire_file_blob for the body given by chunks (the rendered xlsx/csv...): the body is spooled
+    to a temporary file and sent to Postgres by chunks of a temporary table, they are glued by string_agg
+    on the side of Postgres - the whole body is never held in memory.
+    """
+    with TemporaryFile() as body_file, TemporaryFile() as compressed_file:
+        sha256, size = spool_file_body(chunks, body_file)
+        is_exist = db.execute(
+            text("UPDATE file_blob SET ref_count = ref_count + 1 WHERE sha256 = :sha256"), {"sha256": sha256}
+        ).rowcount
+        if is_exist:
+            return sha256
+        compression = compress_file_stream(body_file, compressed_file, size)
+        stored_file = body_file if compression is None else compressed_file
+        db.execute(text("CREATE TEMP TABLE file_blob_part (num integer, chunk bytea) ON COMMIT DROP"))
+        num = 0
+        while chunk := stored_file.read(chunk_size):
+            db.execute(
+                text("INSERT INTO file_blob_part (num, chunk) VALUES (:num, :chunk)"), {"num": num, "chunk": chunk}
+            )
+            num += 1
+        db.execute(
+            text(
+                "INSERT INTO file_blob (sha256, compression, size, ref_count, body) "
+                "SELECT :sha256, :compression, :size, 1, "
+                "coalesce(string_agg(chunk, ''::bytea ORDER BY num), ''::bytea) FROM file_blob_part "
+                "ON CONFLICT (sha256) DO UPDATE SET ref_count = file_blob.ref_count + 1"
+            ),
+            {"sha256": sha256, "compression": compression, "size": size},
+        )
+        db.execute(text("DROP TABLE file_blob_part"))
+    return sha256
+
+
+def release_file_blob(db: Session, sha256: Optional[str]):
+    """Removes one reference to the blob, the blob without references is deleted."""
+    if sha256 is None:
+        return
+    db.execute(text("UPDATE file_blob SET ref_count = ref_count - 1 WHERE sha256 = :sha256"), {"sha256": sha256})
+    db.execute(
+        text(
+            "DELETE FROM file_blob b WHERE b.sha256 = :sha256 AND b.ref_count <= 0 "
+            "AND NOT EXISTS (SELECT 1 FROM file_storage s WHERE s.blob_sha256 = b.sha256)"
+        ),
+        {"sha256": sha256},
+    )
+
+
+def create_file_storage(db: Session, file_name: str, file_body: Union[bytes, Iterable[bytes]]) -> models.FileStorage:
+    """
+    The row of file_storage referencing the shared blob (flush only - the caller commits),
+    file_body - the bytes or the iterable of the chunks of the body (see acquire_file_blob_by_chunks).
+    """
+    if isinstance(file_body, (bytes, bytearray)):
+        blob_sha256 = acquire_file_blob(db, file_body)
+    else:
+        blob_sha256 = acquire_file_blob_by_chunks(db, file_body)
+    db_file_storage = models.FileStorage(file_name=file_name, blob_sha256=blob_sha256)
+    db.add(db_file_storage)
+    db.flush()
+    return db_file_storage
+
+
+def update_file_storage(db: Session, file_storage_id: int, file_name: str, file_body: bytes):
+    db_file_storage = db.query(models.FileStorage).filter(models.FileStorage.id == file_storage_id).first()
+    if db_file_storage is None:
+        raise HTTPException(status_code=404, detail=f"FileStorage with ID={file_storage_id} not found")
+    old_sha256 = db_file_storage.blob_sha256
+    db_file_storage.file_name = file_name
+    db_file_storage.blob_sha256 = acquire_file_blob(db, file_body)
+    db_file_storage.file_body = None
+    db.flush()
+    release_file_blob(db, old_sha256)
+
+
+def delete_file_storage(db: Session, file_storage_id: Optional[int]):
+    db_file_storage = db.query(models.FileStorage).filter(models.FileStorage.id == file_storage_id).first()
+    if db_file_storage is None:
+        return
+    sha256 = db_file_storage.blob_sha256
+    db.delete(db_file_storage)
+    db.flush()
+    release_file_blob(db, sha256)
+
+
+def get_file_storage_body(db: Session, db_file_storage: models.FileStorage) -> bytes:
+    if db_file_storage.blob_sha256 is None:
+        return bytes(db_file_storage.file_body or b"")
+    compression, body = db.execute(
+        text("SELECT compression, body FROM file_blob WHERE sha256 = :sha256"), {"sha256": db_file_storage.blob_sha256}
+    ).first()
+    return decompress_file_body(body, compression)
+
+
+def collect_file_blob_garbage(db: Session) -> int:
+    """
+    Recounts the references of the blobs by file_storage (repairs the counters after the rows of file_storage
+    were deleted bypassing delete_file_storage) and deletes the blobs without references.
+    """
+    db.execute(
+        text(
+            "UPDATE file_blob b SET ref_count = s.cnt FROM ("
+            "  SELECT b2.sha256, count(s2.id) AS cnt FROM file_blob b2"
+            "  LEFT JOIN file_storage s2 ON s2.blob_sha256 = b2.sha256 GROUP BY b2.sha256"
+            ") s WHERE s.sha256 = b.sha256 AND b.ref_count <> s.cnt"
+        )
+    )
+    deleted = db.execute(
+        text(
+            "DELETE FROM file_blob b WHERE b.ref_count <= 0 "
+            "AND NOT EXISTS (SELECT 1 FROM file_storage s WHERE s.blob_sha256 = b.sha256)"
+        )
+    ).rowcount
+    db.commit()
+    return deleted
+
+
+def save_calc_tou_artifact(
+    db: Session,
+    calc_tou_id: int,
+    kind: str,
+    file_name: str,
+    file_body: Union[bytes, Iterable[bytes]],
+    is_replace: bool = True,
+    is_commit: bool = True,
+) -> models.FileStorage:
+    """
+    Saves the artifact of the calculation (file_body - see create_file_storage), returns its FileStorage.
+    is_replace=False - the artifact saved by the parallel transaction (the same render, for example) is kept
+    and returned, the new body is dropped.
+    is_commit=False - flush only, the caller commits (the lock of the artifacts is held till the commit).
+    The artifact "result_xlsx" is also the result of the calculation for CalcTOU.file_storage_id.
+    """
+    db_file_storage = create_file_storage(db, file_name, file_body)
+    # the writers of the artifacts of one calculation are serialized (till the commit) -
+    # the parallel first saves do not fail on UniqueConstraint(calc_tou_id, kind)
+    db.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext('calc_tou_artifact'), :calc_tou_id)"), {"calc_tou_id": calc_tou_id}
+    )
+    db_artifact = get_calc_tou_artifact(db, calc_tou_id, kind, is_body=False)
+    if db_artifact and not is_replace:
+        delete_file_storage(db, db_file_storage.id)
+        if is_commit:
+            db.commit()
+        return get_calc_tou_artifact(db, calc_tou_id, kind)
+    if db_artifact:
+        old_file_storage_id = db_artifact.file_storage_id
+        db_artifact.file_storage_id = db_file_storage.id
+        db.flush()
+        delete_file_storage(db, old_file_storage_id)
+    else:
+        db.add(models.CalcTouArtifact(calc_tou_id=calc_tou_id, kind=kind, file_storage_id=db_file_storage.id))
+    if kind == "result_xlsx":
+        # for the clients which download the result by CalcTOU.file_storage_id
+        db.query(models.CalcTOU).filter(models.CalcTOU.id == calc_tou_id).update(
+            {"file_storage_id": db_file_storage.id}
+        )
+    if is_commit:
+        db.commit()
+    return db_file_storage
+
+
+def get_calc_tou_artifact(db: Session, calc_tou_id: int, kind: str, is_body: bool = True):
+    """Returns FileStorage of the artifact (is_body=True) or the CalcTouArtifact row, None if it is absent."""
+    if not is_body:
+        return (
+            db.query(models.CalcTouArtifact)
+            .filter(models.CalcTouArtifact.calc_tou_id == calc_tou_id, models.CalcTouArtifact.kind == kind)
+            .first()
+        )
+    return (
+        db.query(models.FileStorage)
+        .join(models.CalcTouArtifact, models.CalcTouArtifact.file_storage_id == models.FileStorage.id)
+        .filter(models.CalcTouArtifact.calc_tou_id == calc_tou_id, models.CalcTouArtifact.kind == kind)
+        .first()
+    )
+
+
+def delete_calc_tou_artifacts(
+    db: Session, calc_tou_id: int, kind_list: Optional[list[str]] = None, is_commit: bool = True
+):
+    """Deletes the artifacts of kind_list (None - all) with their file_storage (is_commit=False - flush only)."""
+    query = db.query(models.CalcTouArtifact).filter(models.CalcTouArtifact.calc_tou_id == calc_tou_id)
+    if kind_list is not None:
+        query = query.filter(models.CalcTouArtifact.kind.in_(kind_list))
+    db_artifact_list = query.all()
+    for db_artifact in db_artifact_list:
+        file_storage_id = db_artifact.file_storage_id
+        db.delete(db_artifact)
+        db.flush()
+        delete_file_storage(db, file_storage_id)
+    if is_commit:
+        db.commit()
+
+
+def check_calc_tou_projection(
+    db: Session,
+    calc_tou_id: int,
+    base_year: Optional[int] = None,
+    amount_year_period: Optional[int] = None,
+    seasonal_coefficient_id: Optional[int] = None,
+) -> dict:
+    """
+    Checks that the finished calculation can be re-projected, returns the changed parameters (they are saved
+    together with the new result - see reproject_calc_tou).
+    """
+    db_calc_tou = get_calc_tou(db, calc_tou_id)
+    if db_calc_tou.status != CalcStateEnum.done:
+        raise HTTPException(
+            status_code=422,
+            detail=f"The re-projection is possible only for the finished calculation "
+            f"(status = {db_calc_tou.status.value}, but need {CalcStateEnum.done.value})",
+        )
+    if not get_calc_tou_artifact(db, calc_tou_id, "aggregate", is_body=False):
+        raise HTTPException(
+            status_code=422,
+            detail=f"CalcTOU with ID={calc_tou_id} has no stored aggregate (it must be calculated again)",
+        )
+    if seasonal_coefficient_id is not None and not get_season_coefficient(db, seasonal_coefficient_id):
+        raise HTTPException(status_code=404, detail=f"Seasonal coefficient with id={seasonal_coefficient_id} not found")
+    update_kwargs = {
+        "base_year": base_year,
+        "amount_year_period": amount_year_period,
+        "seasonal_coefficient_id": seasonal_coefficient_id,
+    }
+    return {key: value for key, value in update_kwargs.items() if value is not None}
+
+
 def get_calc_tou_list(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.CalcTOU).offset(skip).limit(limit).all()
 
@@ -430,6 +1026,9 @@ def get_calc_tou(db: Session, calc_tou_id: int):
 
 def delete_calc_tou(db: Session, calc_tou_id: int):
     db_calc_tou = get_calc_tou(db, calc_tou_id)
+    # the artifacts are deleted by the cascade, their file_storage (and the result) - only here
+    delete_calc_tou_artifacts(db, calc_tou_id)
+    delete_file_storage(db, db_calc_tou.file_storage_id)
     calc_tou_delete_rps(db, calc_tou_id)
     calc_tou_delete_station(db, calc_tou_id)
     calc_tou_delete_type_operation(db, calc_tou_id)
@@ -628,11 +1227,7 @@ async def create_calc_tou_external(
     db: Session, calc_tou_external: schemas.CalcTouExternalCreate, uploaded_file: UploadFile
 ):
     content = await uploaded_file.read()  # async read
-    db_file_storage = models.FileStorage(
-        file_name=uploaded_file.filename,
-        file_body=content,
-    )
-    db.add(db_file_storage)
+    db_file_storage = create_file_storage(db, uploaded_file.filename, content)
     db.commit()
 
     msg = get_info_from_excel(content)
@@ -688,9 +1283,7 @@ async def update_calc_tou_external_file(db: Session, calc_tou_external_id: int,
     if calc_tou_external.file_storage_id is None:
         raise HTTPException(status_code=404, detail="FileStorage with ID=NULL not found")
     try:
-        db.query(models.FileStorage).filter(models.FileStorage.id == calc_tou_external.file_storage_id).update(
-            {"file_name": uploaded_file.filename, "file_body": content}
-        )
+        update_file_storage(db, calc_tou_external.file_storage_id, uploaded_file.filename, content)
         db.commit()
         msg = get_info_from_excel(content)
         write_log(db=db, parent_id=calc_tou_external_id, parent_name="calc_tou_external", msg=f"Update file ({msg})")
@@ -704,6 +1297,7 @@ async def update_calc_tou_external_file(db: Session, calc_tou_external_id: int,
 def delete_calc_tou_external(db: Session, calc_tou_external_id: int):
     db_calc_tou_external = get_calc_tou_external(db, calc_tou_external_id)
     db.delete(db_calc_tou_external)
+    delete_file_storage(db, db_calc_tou_external.file_storage_id)
     db.commit()
     return {"message": "OK"}
 
@@ -1,22 +1,27 @@
 import datetime
 
 from sqlalchemy import (
+    DDL,
     BigInteger,
+    Boolean,
     Column,
     Date,
+    DateTime,
     ForeignKey,
+    Index,
     Integer,
     Numeric,
     SmallInteger,
     String,
     Text,
     UniqueConstraint,
+    event,
 )
 from sqlalchemy.dialects.postgresql import BYTEA, ENUM
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import deferred, relationship
 
 from app.core.database import Base
-from app.settings import AmountOperationEnum, CalcStateEnum, CalcTypeMergeEnum, MyLogTypeEnum
+from app.settings import AmountOperationEnum, CalcStateEnum, CalcTypeMergeEnum, LoadJobStateEnum, MyLogTypeEnum
 
 
 class MappingClientCognosToSAP(Base):
@@ -92,13 +97,22 @@ class MappingClientCognosToSAP(Base):
 
 class Fact(Base):
     __tablename__ = "fact"
-    __table_args__ = {
-        "comment": "Факт ТОУ из Cognos и for SAP",
-    }
+    __table_args__ = (
+        # фильтры расчета ТОУ (calc_tou._fact_where) и проверок полноты фактов по датам
+        Index("ix_fact_date_rep_brin", "date_rep", postgresql_using="brin"),
+        Index("ix_fact_date_rep_rps_short_type_op", "date_rep", "rps_short", "type_op"),
+        Index("ix_fact_date_rep_org_id", "date_rep", "org_id"),
+        {
+            "comment": "Факт ТОУ из Cognos и for SAP",
+            # секции по месяцам, внутри - по load_from (см. app.utils.fact_partition)
+            "postgresql_partition_by": "RANGE (date_rep)",
+        },
+    )
 
     id = Column(BigInteger, primary_key=True, autoincrement=True, comment="ID")
-    date_rep = Column(Date, comment="Отчётная дата")
-    load_from = Column(String(10), comment="Загружено из SAP/Cognos")
+    date_rep = Column(Date, primary_key=True, comment="Отчётная дата")
+    # ключ секционирования входит в первичный ключ секционированной таблицы
+    load_from = Column(String(10), primary_key=True, comment="Загружено из SAP/Cognos")
     st_code = Column(String(16), comment="Станция выполнения ГО код")
     st_code_from = Column(String(16), comment="Станция отправления код")
     st_code_to = Column(String(16), comment="Станция назначения код")
@@ -111,6 +125,29 @@ class Fact(Base):
     parking_fact = Column(Numeric, comment="Простои Факт, ваг-сут")
 
 
+class FactCoverage(Base):
+    __tablename__ = "fact_coverage"
+    __table_args__ = {
+        "comment": "Количество записей Fact по дням и источникам (обновляется загрузками за затронутые даты)",
+    }
+
+    date_rep = Column(Date, primary_key=True, comment="Отчётная дата")
+    load_from = Column(String(10), primary_key=True, comment="Загружено из SAP/Cognos")
+    row_count = Column(BigInteger, default=0, comment="Количество записей")
+    date_update = Column(DateTime, default=datetime.datetime.now, comment="Дата/время изменения")
+
+
+class FactMonthVersion(Base):
+    __tablename__ = "fact_month_version"
+    __table_args__ = {
+        "comment": "Версия данных Fact по месяцам (увеличивается при каждой загрузке/удалении фактов месяца)",
+    }
+
+    month = Column(Date, primary_key=True, comment="Месяц (первое число)")
+    version = Column(BigInteger, default=1, comment="Версия")
+    date_update = Column(DateTime, default=datetime.datetime.now, comment="Дата/время изменения")
+
+
 class Rps(Base):
     __tablename__ = "rps"
     __table_args__ = {
@@ -186,6 +223,63 @@ class CalcTouLoaded(Base):
     month = Column(SmallInteger, comment="Месяц")
 
 
+class CalcTouQueue(Base):
+    __tablename__ = "calc_tou_queue"
+    __table_args__ = {
+        "comment": "Очередь запусков расчетов ТОУ (выполняет app.worker)",
+    }
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True, comment="ID")
+    calc_tou_id = Column(ForeignKey("calc_tou.id", ondelete="CASCADE"), index=True, comment="ID расчета ТОУ")
+    username = Column(String(20), comment="Пользователь, запустивший расчет")
+    attempt = Column(SmallInteger, default=0, comment="Номер попытки выполнения")
+    worker = Column(String(80), nullable=True, comment="Обработчик (host:pid), взявший расчет")
+    date_queued = Column(DateTime, default=datetime.datetime.now, comment="Дата/время постановки в очередь")
+    date_start = Column(DateTime, nullable=True, comment="Дата/время начала выполнения")
+    date_heartbeat = Column(DateTime, nullable=True, comment="Дата/время последнего подтверждения обработчика")
+    date_finish = Column(DateTime, nullable=True, comment="Дата/время окончания выполнения")
+
+
+class LoadJob(Base):
+    __tablename__ = "load_job"
+    __table_args__ = {
+        "comment": "Задания загрузки файлов Fact (Cognos/SAP), выполняет app.worker или фон API",
+    }
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True, comment="ID")
+    load_from = Column(String(10), comment="Загружено из SUP/Cognos")
+    is_overwrite = Column(Boolean, default=True, comment="Заменить ранее загруженный Fact за период файлов")
+    status = Column(ENUM(LoadJobStateEnum), default="NEW", comment="Статус")
+    username = Column(String(20), comment="Пользователь, загрузивший файлы")
+    attempt = Column(SmallInteger, default=0, comment="Номер попытки выполнения")
+    worker = Column(String(80), nullable=True, comment="Обработчик (host:pid), взявший задание")
+    date_queued = Column(DateTime, default=datetime.datetime.now, comment="Дата/время постановки в очередь")
+    date_start = Column(DateTime, nullable=True, comment="Дата/время начала выполнения")
+    date_heartbeat = Column(DateTime, nullable=True, comment="Дата/время последнего подтверждения обработчика")
+    date_finish = Column(DateTime, nullable=True, comment="Дата/время окончания выполнения")
+
+    file_list = relationship("LoadJobFile", cascade="all,delete", backref="load_job", order_by="LoadJobFile.id")
+
+
+class LoadJobFile(Base):
+    __tablename__ = "load_job_file"
+    __table_args__ = {
+        "comment": "Файлы заданий загрузки Fact и ход их обработки",
+    }
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True, comment="ID")
+    load_job_id = Column(ForeignKey("load_job.id", ondelete="CASCADE"), index=True, comment="ID задания загрузки")
+    file_name = Column(String(255), comment="Наименование файла")
+    file_path = Column(String(1024), comment="Путь к файлу в каталоге заданий (LOAD_JOB_SPOOL_DIR)")
+    stage = Column(String(20), default="queued", comment="Этап: queued/parsing/parsed/enriched/copying/copied")
+    rows_parsed = Column(BigInteger, nullable=True, comment="Прочитано строк")
+    rows_enriched = Column(BigInteger, nullable=True, comment="Обогащено строк (строк Fact)")
+    rows_copied = Column(BigInteger, nullable=True, comment="Записано строк в Fact")
+    rows_per_sec = Column(Numeric(precision=12, scale=1), nullable=True, comment="Скорость последнего этапа, строк/с")
+    date_start = Column(DateTime, nullable=True, comment="Дата/время начала обработки")
+    date_update = Column(DateTime, nullable=True, comment="Дата/время окончания последнего этапа")
+
+
 class CalcTouLinkRps(Base):
     __tablename__ = "calc_tou_link_rps"
     __table_args__ = {
@@ -276,6 +370,19 @@ class CalcTouExternal(Base):
     file_storage_id = Column(BigInteger, nullable=True, comment="ID результата расчета в хранилище")
 
 
+class FileBlob(Base):
+    __tablename__ = "file_blob"
+    __table_args__ = {
+        "comment": "Тела файлов file_storage (одно тело на SHA-256, см. app.utils.file_blob)",
+    }
+
+    sha256 = Column(String(64), primary_key=True, comment="SHA-256 исходного (несжатого) тела")
+    compression = Column(String(10), nullable=True, comment="Сжатие тела (zstd) или NULL - хранится как есть")
+    size = Column(BigInteger, comment="Размер исходного тела, байт")
+    ref_count = Column(Integer, default=0, comment="Количество ссылок из file_storage")
+    body = deferred(Column(BYTEA(), comment="Тело файла"))
+
+
 class FileStorage(Base):
     __tablename__ = "file_storage"
     __table_args__ = {
@@ -284,7 +391,49 @@ class FileStorage(Base):
 
     id = Column(BigInteger, primary_key=True, autoincrement=True, comment="ID")
     file_name = Column(String(80), comment="Наименование файла")
-    file_body = Column(BYTEA(), comment="Тело файла")
+    blob_sha256 = Column(ForeignKey("file_blob.sha256"), nullable=True, index=True, comment="Тело в file_blob")
+    # тело строк, созданных до file_blob (новые строки его не заполняют)
+    file_body = deferred(Column(BYTEA(), comment="Тело файла"))
+
+
+# тело хранится в TOAST без сжатия (xlsx/parquet/zstd уже сжаты) - substring() при скачивании по частям
+# читает только нужные куски, а не распаковывает весь файл
+event.listen(
+    FileBlob.__table__,
+    "after_create",
+    DDL("ALTER TABLE file_blob ALTER COLUMN body SET STORAGE EXTERNAL"),
+)
+event.listen(
+    FileStorage.__table__,
+    "after_create",
+    DDL("ALTER TABLE file_storage ALTER COLUMN file_body SET STORAGE EXTERNAL"),
+)
+
+
+def add_new_columns(engine):
+    """
+    create_all creates only the absent tables - the columns added to the existing tables later are added here
+    (the databases created before them).
+    """
+    with engine.begin() as connection:
+        connection.execute(
+            "ALTER TABLE file_storage ADD COLUMN IF NOT EXISTS blob_sha256 varchar(64) REFERENCES file_blob (sha256)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_file_storage_blob_sha256 ON file_storage (blob_sha256)")
+        connection.execute("COMMENT ON COLUMN file_storage.blob_sha256 IS 'Тело в file_blob'")
+
+
+class CalcTouArtifact(Base):
+    __tablename__ = "calc_tou_artifact"
+    __table_args__ = (
+        UniqueConstraint("calc_tou_id", "kind"),
+        {"comment": "Промежуточные результаты расчета ТОУ (для пересчета без чтения Fact)"},
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True, comment="ID")
+    calc_tou_id = Column(ForeignKey("calc_tou.id", ondelete="CASCADE"), index=True, comment="ID расчета ТОУ")
+    kind = Column(String(20), comment="Вид (aggregate - агрегат до проекции по годам и сезонности)")
+    file_storage_id = Column(ForeignKey("file_storage.id", ondelete="CASCADE"), comment="ID тела в хранилище")
 
 
 class Log(Base):
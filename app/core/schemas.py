@@ -3,7 +3,7 @@ from typing import Optional
 
 from pydantic import BaseModel
 
-from app.settings import AmountOperationEnum, CalcStateEnum, CalcTypeMergeEnum, MyLogTypeEnum
+from app.settings import AmountOperationEnum, CalcStateEnum, CalcTypeMergeEnum, LoadJobStateEnum, MyLogTypeEnum
 
 
 class OurBaseModel(BaseModel):
@@ -204,6 +204,42 @@ class StationCreate(StationBase):
     pass
 
 
+class FactCoverageGaps(OurBaseModel):
+    date_from: datetime.date
+    date_to: datetime.date
+    days: int
+    is_complete: bool
+    missing_days: list[datetime.date] = []
+    missing_by_source: dict[str, list[datetime.date]] = {}
+
+
+class LoadJobFile(OurBaseModel):
+    id: int
+    file_name: str
+    stage: str
+    rows_parsed: Optional[int] = None
+    rows_enriched: Optional[int] = None
+    rows_copied: Optional[int] = None
+    rows_per_sec: Optional[float] = None
+    date_start: Optional[datetime.datetime] = None
+    date_update: Optional[datetime.datetime] = None
+
+
+class LoadJob(OurBaseModel):
+    id: int
+    load_from: str
+    is_overwrite: bool
+    status: LoadJobStateEnum
+    username: Optional[str] = None
+    attempt: Optional[int] = None
+    worker: Optional[str] = None
+    date_queued: Optional[datetime.datetime] = None
+    date_start: Optional[datetime.datetime] = None
+    date_finish: Optional[datetime.datetime] = None
+    file_list: list[LoadJobFile] = []
+    log: Optional[str] = ""
+
+
 class FileStorage(OurBaseModel):
     id: int
     file_name: str
@@ -1,4 +1,5 @@
 import asyncio
+import time
 from pathlib import Path
 
 from fastapi import FastAPI
@@ -6,7 +7,6 @@ from fastapi.exceptions import HTTPException, RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.middleware.gzip import GZipMiddleware
 from starlette.responses import JSONResponse
 from starlette.staticfiles import StaticFiles
 
@@ -14,11 +14,12 @@ from app.api.router import router, router_test
 from app.auth.crud import check_token
 from app.auth.router import auth_router
 from app.core import models
-from app.core.crud import fact_fully_loaded_slow_background
+from app.core.crud import backfill_fact_coverage, fact_fully_loaded_slow_background, recover_stale_load_job
 
-from app.core.database import EnginePostresql
+from app.core.database import EnginePostresql, SessionLocal
 from app.settings import Configuration, load_configuration
 from app.utils.exceptions import api_error_responses, http_exception_handler, validation_exception_handler
+from app.utils.gzip import SelectiveGZipMiddleware
 from app.utils.responses import WrappedResponse
 from app.utils.sentry import init_sentry
 
@@ -70,7 +71,7 @@ def create_app(config: Configuration) -> FastAPI:
         allow_headers=["*"],
     )
     application.add_middleware(
-        GZipMiddleware,
+        SelectiveGZipMiddleware,
         minimum_size=config.GZIP_MINIMUM_SIZE,
     )
     # application.add_middleware(CheckApiKey)
@@ -110,17 +111,43 @@ app = create_app(configuration)
 #     return response
 
 
+def backfill_fact_coverage_background():
+    with SessionLocal() as db:
+        backfill_fact_coverage(db)
+
+
+def recover_stale_load_job_background(interval_sec: int):
+    # without app.worker (LOAD_JOB_QUEUE=False) the load jobs of the dead API processes are closed by the API itself
+    while True:
+        try:
+            with SessionLocal() as db:
+                recover_stale_load_job(
+                    db, configuration.LOAD_JOB_QUEUE_STALE_SEC, configuration.LOAD_JOB_QUEUE_MAX_ATTEMPT
+                )
+        except Exception as err:
+            print(f"load_job: the recovery of the stale jobs failed ({err!r})")
+        time.sleep(interval_sec)
+
+
 @app.on_event("startup")
 async def startup_event() -> None:
     """tasks to do at server startup"""
     # asyncio.create_task(fact_fully_loaded_slow_background(10), name="Background_task")
     # fastapi.BackgroundTasks().add_task(asyncio.run, fact_fully_loaded_slow_background, 10)
     # create and start the daemon thread
-    print("Starting background task... (every day = 86400sec)")
+    # the coverage is maintained by the loaders, the full reconciliation is optional
     loop = asyncio.get_running_loop()
-    asyncio.gather(
-        loop.run_in_executor(None, fact_fully_loaded_slow_background, 86400),
-    )
+    # the databases created before fact_coverage - it is filled once by the full scan of fact
+    loop.run_in_executor(None, backfill_fact_coverage_background)
+    if not configuration.LOAD_JOB_QUEUE:
+        loop.run_in_executor(
+            None, recover_stale_load_job_background, max(configuration.LOAD_JOB_QUEUE_STALE_SEC // 10, 1)
+        )
+    if configuration.FACT_COVERAGE_RECONCILE_SEC:
+        print(f"Starting background task... (every {configuration.FACT_COVERAGE_RECONCILE_SEC}sec)")
+        asyncio.gather(
+            loop.run_in_executor(None, fact_fully_loaded_slow_background, configuration.FACT_COVERAGE_RECONCILE_SEC),
+        )
     # daemon = Thread(target=fact_fully_loaded_slow_background, args=(86400,), daemon=True, name="Background")
     # daemon.start()
     # # main thread is carrying on...
@@ -128,3 +155,4 @@ async def startup_event() -> None:
 
 
 models.Base.metadata.create_all(bind=EnginePostresql)
+models.add_new_columns(EnginePostresql)
@@ -89,6 +89,23 @@ class Configuration(BaseModel):
     AUTHORISE_BY_WHITE_LIST: bool = False
 
     GZIP_MINIMUM_SIZE: int = 500
+    CALC_TOU_WORKERS: int = 1  # > 1 - calc_tou reads and aggregates the facts in the pool of processes
+    CALC_TOU_QUEUE: bool = False  # True - "calc-tou-start" puts the calculation into the queue of app.worker
+    CALC_TOU_JOB_SLOTS: int = 1  # how many calculations one app.worker executes at the same time
+    CALC_TOU_QUEUE_POLL_SEC: int = 5
+    CALC_TOU_QUEUE_STALE_SEC: int = 600  # a job without heartbeat of its worker is considered as lost
+    CALC_TOU_QUEUE_MAX_ATTEMPT: int = 2
+    CALC_CACHE_MAX_BYTES: int = 2 * 1024**3  # disk budget of the calc_tou aggregate cache (0 - disabled)
+    # the coverage of fact is maintained by the loaders, > 0 - the full reconciliation every N sec in background
+    FACT_COVERAGE_RECONCILE_SEC: int = 0
+    # True - the overwrite of fact is made via the unlogged staging table (COPY, check, one transaction of replace)
+    FACT_OVERWRITE_STAGING: bool = True
+    FACT_LOAD_WORKERS: int = 4  # > 1 - "load-*-excel-list" reads and cleans the files in the pool of processes
+    LOAD_JOB_QUEUE: bool = False  # True - "load-job" is executed by app.worker, otherwise in the background of API
+    LOAD_JOB_SLOTS: int = 1  # how many load jobs one app.worker executes at the same time
+    LOAD_JOB_QUEUE_STALE_SEC: int = 600  # a load job without heartbeat of its process is considered as lost
+    LOAD_JOB_QUEUE_MAX_ATTEMPT: int = 2
+    LOAD_JOB_SPOOL_DIR: str = ""  # the uploaded files of the load jobs ("" - _import/load_job, shared by the workers)
     SENTRY: bool = False
     # SENTRY_DSN: str
     # REDIS: bool = False
@@ -160,6 +177,13 @@ class AmountOperationEnum(enum.Enum):
     three = "loading/unloading/shifting"
 
 
+class LoadJobStateEnum(enum.Enum):
+    new = "NEW"
+    in_process = "IN_PROCESS"
+    done = "DONE"
+    error = "ERROR"
+
+
 class MyLogTypeEnum(enum.Enum):
     START = "start"
     FINISH = "finish"
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+
+from app.utils.utils import IteratorFile, render_copy_batch
+
+
+def make_fact_df(rows: int):
+    rng = np.random.default_rng(1)
+    return pd.DataFrame(
+        {
+            "date_rep": pd.Timestamp("2022-01-01") + pd.to_timedelta(rng.integers(0, 365, rows), unit="D"),
+            "st_code": rng.integers(0, 99999, rows).astype(str),
+            "org_id": rng.integers(1, 20, rows),
+            "parking_fact": np.where(rng.random(rows) < 0.1, np.nan, rng.random(rows).round(6)),
+            "client": np.where(rng.random(rows) < 0.1, None, "client"),
+        }
+    )
+
+
+def parse_copy_text(text: str) -> list[list]:
+    # the reader of the text format of COPY (NULL ''): backslash + char - the char itself, \\t \\n \\r
+    rows, row, value, is_escaped = [], [], [], False
+    for char in text:
+        if is_escaped:
+            value.append({"t": "\t", "n": "\n", "r": "\r"}.get(char, char))
+            is_escaped = False
+        elif char == "\\":
+            is_escaped = True
+        elif char == "\t":
+            row.append("".join(value) or None)
+            value = []
+        elif char == "\r":
+            continue
+        elif char == "\n":
+            row.append("".join(value) or None)
+            rows.append(row)
+            row, value = [], []
+        else:
+            value.append(char)
+    return rows
+
+
+def test_render_copy_batch_same_as_to_csv():
+    df = make_fact_df(1000)
+    expected = df.to_csv(sep="\t", header=False, index=False).replace("\n", "\r\n")
+    assert render_copy_batch(df, list(df.columns)) == expected
+
+
+def test_render_copy_batch_escapes_text():
+    names = ["a\tb", "c\nd", "e\rf", "g\\h", 'o"k & co', "\\", None]
+    df = pd.DataFrame({"name": names, "num": range(len(names))})
+    rows = parse_copy_text(render_copy_batch(df, ["name", "num"]))
+    assert rows == [[name, str(num)] for num, name in enumerate(names)]
+
+
+def test_render_copy_batch_one_column():
+    df = pd.DataFrame({"name": ["a", None, "b\t", ""]})
+    assert parse_copy_text(render_copy_batch(df, ["name"])) == [["a"], [None], ["b\t"], [None]]
+
+
+def test_render_copy_batch_cuts_varchar_without_changing_df():
+    df = pd.DataFrame({"st_code": ["1234567", "12", None, 123456789], "org_id": [1, 2, 3, 4]})
+    rows = parse_copy_text(render_copy_batch(df, ["st_code", "org_id"], {"st_code": 5}))
+    assert [row[0] for row in rows] == ["12345", "12", None, "12345"]
+    assert df["st_code"].tolist() == ["1234567", "12", None, 123456789]
+
+
+def test_iterator_file_streams_all_batches():
+    batches = ["row1\n", "row2\nrow3\n", "", "row4\n"]
+    stream = IteratorFile(iter(batches))
+    result = []
+    while True:
+        chunk = stream.read(3)
+        if not chunk:
+            break
+        assert len(chunk) <= 3
+        result.append(chunk)
+    assert "".join(result) == "".join(batches)
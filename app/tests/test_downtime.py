@@ -0,0 +1,62 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.utils.downtime import calc_downtime
+
+
+def calc_downtime_row(row):
+    # the previous implementation from load_cognos_file (report_df.apply(calc_downtime, axis=1))
+    if row["Сдвоенная операция"] != "да":
+        result = (row["Дата приема след."] - row["Дата прибытия тек."]).total_seconds() / timedelta(
+            days=1
+        ).total_seconds()
+    elif row["Ваг-сут простоя для сдвоенных"] > 0:
+        result = (
+            ((row["Дата приема след."] - row["Дата прибытия тек."]).total_seconds() / timedelta(days=1).total_seconds())
+            / row["Ваг-сут простоя для сдвоенных"]
+            * row["Факт ваг-сут простоя"]
+        )
+    else:
+        result = row["Факт ваг-сут простоя"]
+    return round(result, 6)
+
+
+def make_cognos_df(rows: int, seed: int):
+    rng = np.random.default_rng(seed)
+    arrival = pd.Timestamp("2022-01-01") + pd.to_timedelta(rng.integers(0, 31 * 24 * 60, rows), unit="min")
+    df = pd.DataFrame(
+        {
+            "Отчетная дата": arrival.normalize(),
+            "Дата прибытия тек.": arrival,
+            "Дата приема след.": arrival + pd.to_timedelta(rng.integers(0, 40 * 24 * 3600, rows), unit="s"),
+            "Сдвоенная операция": rng.choice(["да", "нет", None], rows, p=[0.3, 0.6, 0.1]),
+            "Факт ваг-сут простоя": np.round(rng.uniform(0, 30, rows), 2),
+            "Ваг-сут простоя для сдвоенных": rng.choice([0.0, 1.5, 7.25, np.nan, 12.0], rows),
+        }
+    )
+    df.loc[rng.random(rows) < 0.03, "Дата приема след."] = pd.NaT
+    df.loc[rng.random(rows) < 0.02, "Факт ваг-сут простоя"] = np.nan
+    return df
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_calc_downtime_parity(seed):
+    df = make_cognos_df(20000, seed)
+    expected = df.apply(calc_downtime_row, axis=1)
+    pd.testing.assert_series_equal(calc_downtime(df), expected, check_names=False, check_dtype=False, check_exact=True)
+
+
+def test_calc_downtime_cases():
+    df = pd.DataFrame(
+        {
+            "Дата прибытия тек.": pd.to_datetime(["2022-01-01 00:00"] * 3),
+            "Дата приема след.": pd.to_datetime(["2022-01-03 12:00"] * 3),
+            "Сдвоенная операция": ["нет", "да", "да"],
+            "Факт ваг-сут простоя": [9.0, 1.0, 3.0],
+            "Ваг-сут простоя для сдвоенных": [0.0, 2.0, 0.0],
+        }
+    )
+    assert calc_downtime(df).tolist() == [2.5, 1.25, 3.0]
@@ -0,0 +1,40 @@
+from io import BytesIO
+
+from app.utils.file_blob import (
+    compress_file_body,
+    compress_file_stream,
+    decompress_file_body,
+    file_body_hash,
+    iter_decompressed_chunks,
+    spool_file_body,
+)
+
+
+def test_spool_file_body_hashes_chunks():
+    chunks = [b"date;st_code\n", b"", b"2022-01-01;12345\n" * 1000]
+    file = BytesIO()
+    sha256, size = spool_file_body(iter(chunks), file)
+    assert (sha256, size) == (file_body_hash(b"".join(chunks)), len(b"".join(chunks)))
+    assert file.read() == b"".join(chunks)
+
+
+def test_compress_file_stream_same_as_compress_file_body():
+    file_body = b"2022-01-01;12345;client\n" * 10000
+    target = BytesIO()
+    compression = compress_file_stream(BytesIO(file_body), target, len(file_body))
+    assert compression == compress_file_body(file_body)[1] == "zstd"
+    assert decompress_file_body(target.read(), compression) == file_body
+
+
+def test_compress_file_stream_keeps_compressed_body():
+    file_body = b"PK\x03\x04" + bytes(range(256)) * 100
+    source, target = BytesIO(file_body), BytesIO()
+    assert compress_file_stream(source, target, len(file_body)) is None
+    assert source.read() == file_body
+
+
+def test_iter_decompressed_chunks_by_small_chunks():
+    file_body = b"2022-01-01;12345;client\n" * 10000
+    stored_body, compression = compress_file_body(file_body)
+    stored_chunks = (stored_body[pos : pos + 100] for pos in range(0, len(stored_body), 100))
+    assert b"".join(iter_decompressed_chunks(stored_chunks, compression)) == file_body
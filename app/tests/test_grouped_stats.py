@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.utils.grouped_stats import grouped_stats
+
+
+def grouped_stats_lambda(df, by, value_col, count_col):
+    # the previous implementation from calc_tou (python lambda per group)
+    result = df.groupby(by).agg(
+        {
+            count_col: [("count", "count")],
+            value_col: [
+                ("mean", "mean"),
+                (0.25, lambda x: x.quantile(0.25)),
+                (0.5, lambda x: x.quantile(0.5)),
+                ("mode", lambda x: pd.Series.mode(round(x, 2))[0]),
+            ],
+        }
+    )
+    result.columns = result.columns.droplevel()
+    return result
+
+
+def make_fact_df(rows: int, seed: int):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {
+            "rps": rng.choice(["ПВ", "КР", "ПЛ", "ЦМВ"], rows),
+            "st_code": rng.choice(["010203", "020304", "030405", None], rows, p=[0.4, 0.3, 0.29, 0.01]),
+            "cargo": rng.integers(0, 5, rows).astype(float),
+            "wagon": rng.integers(50000000, 59999999, rows),
+            # many ties after round(x, 2)
+            "parking": np.round(rng.uniform(0.4, 30, rows), 3),
+        }
+    )
+    df.loc[rng.random(rows) < 0.05, "parking"] = rng.choice([1.005, 2.5, 2.515, 3.0])
+    return df
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+@pytest.mark.parametrize("by", [["rps"], ["rps", "st_code", "cargo"]])
+def test_grouped_stats_equal_lambda(seed, by):
+    df = make_fact_df(5000, seed)
+    expected = grouped_stats_lambda(df, by, "parking", "wagon")
+    result = grouped_stats(df, by, "parking", "wagon")
+    pd.testing.assert_frame_equal(result, expected, check_exact=True, check_names=True)
+
+
+def test_grouped_stats_mode_tie():
+    df = pd.DataFrame({"key": ["a"] * 4 + ["b"] * 3, "wagon": range(7), "parking": [3, 3, 1, 1, 5, 2, 7]})
+    result = grouped_stats(df, ["key"], "parking", "wagon")
+    assert list(result["mode"]) == [1, 2]
+    assert list(result["count"]) == [4, 3]
@@ -0,0 +1,85 @@
+import datetime
+from io import BytesIO
+
+import pandas as pd
+import pytest
+import xlsxwriter
+from fastapi import HTTPException
+
+from app.utils import report_reader
+from app.utils.report_reader import iter_report_chunks, read_report
+
+HEADERS = ["Отчётная дата", "№ вагона", "Сдвоенная\nоперация", "Факт ваг-сут\nпростоя"]
+
+
+def make_xlsx(rows: int) -> bytes:
+    stream = BytesIO()
+    workbook = xlsxwriter.Workbook(stream)
+    worksheet = workbook.add_worksheet()
+    date_format = workbook.add_format({"num_format": "dd.mm.yyyy"})
+    worksheet.write(0, 0, "Отчет по простоям")
+    worksheet.write_row(2, 0, ["Лишний"] + HEADERS)
+    for num in range(rows):
+        worksheet.write_string(3 + num, 0, "x")
+        worksheet.write_datetime(3 + num, 1, datetime.datetime(2022, 5, 1 + num % 31), date_format)
+        worksheet.write_number(3 + num, 2, 50000000 + num)
+        if num % 2:
+            worksheet.write_string(3 + num, 3, "да")
+        worksheet.write_number(3 + num, 4, num / 4)
+    worksheet.write_string(3 + rows, 1, "Итого")
+    workbook.close()
+    return stream.getvalue()
+
+
+@pytest.fixture(params=["calamine", "openpyxl"])
+def xlsx_reader(request, monkeypatch):
+    if request.param == "calamine":
+        if report_reader.CalamineWorkbook is None:
+            pytest.skip("python-calamine is not installed")
+    else:
+        monkeypatch.setattr(report_reader, "CalamineWorkbook", None)
+    return request.param
+
+
+def test_read_report_xlsx(xlsx_reader):
+    df = read_report(make_xlsx(100), HEADERS, skip_footer=1)
+    assert list(df.columns) == HEADERS
+    assert df.shape == (100, 4)
+    assert df["Отчётная дата"].dtype == "datetime64[ns]"
+    assert df["№ вагона"].dtype == "int64"
+    assert df["Сдвоенная\nоперация"].isnull().sum() == 50
+    assert df["Факт ваг-сут\nпростоя"].tolist() == [num / 4 for num in range(100)]
+
+
+def test_iter_report_chunks_xlsx(xlsx_reader):
+    chunks = list(iter_report_chunks(make_xlsx(250), HEADERS, skip_footer=1, chunk_size=100))
+    assert [chunk.shape[0] for chunk in chunks] == [100, 100, 50]
+
+
+def test_read_report_headers_not_found():
+    with pytest.raises(HTTPException) as err:
+        read_report(make_xlsx(10), HEADERS + ["Нет такого"], number_analyzed_rows=5)
+    assert err.value.status_code == 422
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "cp1251"])
+def test_read_report_csv(encoding):
+    text = "Отчет по простоям\n\nЛишний;Отчётная дата;Род вагона;Факт ваг-сут простоя\n"
+    text += "".join(f"x;{1 + num % 28:02d}.05.2022 10:30;ПВ;{num},5\n" for num in range(300)) + "Итого;;;\n"
+    df = read_report(text.encode(encoding), ["Факт ваг-сут простоя", "Отчётная дата", "Род вагона"], skip_footer=1)
+    assert df.shape == (300, 3)
+    assert df["Отчётная дата"].iloc[1] == pd.Timestamp("2022-05-02 10:30")
+    assert df["Факт ваг-сут простоя"].iloc[-1] == 299.5
+    assert (df["Род вагона"] == "ПВ").all()
+
+
+@pytest.mark.parametrize("delimiter", ["\t", ","])
+def test_read_report_csv_delimiter_after_title(delimiter):
+    # the title line has no delimiters (or the other ones) - the delimiter is found by the header row
+    text = f"Отчет по простоям; май 2022\n{delimiter.join(['Отчётная дата', 'Род вагона', 'Факт ваг-сут простоя'])}\n"
+    text += "".join(delimiter.join([f"{1 + num % 28:02d}.05.2022", "ПВ", f"{num}.5"]) + "\n" for num in range(50))
+    df = read_report(text.encode("utf-8"), ["Факт ваг-сут простоя", "Отчётная дата", "Род вагона"])
+    assert df.shape == (50, 3)
+    assert df["Отчётная дата"].iloc[1] == pd.Timestamp("2022-05-02")
+    assert df["Факт ваг-сут простоя"].iloc[-1] == 49.5
+    assert (df["Род вагона"] == "ПВ").all()
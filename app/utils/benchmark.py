@@ -1,5 +1,7 @@
 from functools import wraps
-from time import time
+from time import perf_counter, time
+
+from sqlalchemy.engine import Engine
 
 
 def timing(f):
@@ -14,3 +16,137 @@ def timing(f):
         return result
 
     return wrap
+
+
+def benchmark_fact_extraction(postgre_eng: Engine, sql_command: str, chunk_size: int = 3000000) -> dict:
+    """
+    Compares the extraction of the calc_tou input: pd.read_sql by chunks vs "COPY ... TO STDOUT".
+    The frames must be equal: read_sql gives date objects in place of datetime64, so its columns are cast
+    to the dtypes of the COPY frame, the row order of both frames is not defined by the query and is sorted.
+    Example: benchmark_fact_extraction(EnginePostresql, build_fact_sql(get_calc_tou(db, calc_tou_id)))
+    """
+    from pandas.testing import assert_frame_equal
+
+    from app.core.models import Fact
+    from app.utils.utils import read_sql_via_copy, read_sql_with_chunk
+
+    ts = perf_counter()
+    read_sql_df = read_sql_with_chunk(postgre_eng, sql_command, chunk_size)
+    read_sql_time = perf_counter() - ts
+    ts = perf_counter()
+    copy_df = read_sql_via_copy(postgre_eng, sql_command, Fact)
+    copy_time = perf_counter() - ts
+
+    result = {
+        "rows": copy_df.shape[0],
+        "read_sql, sec": round(read_sql_time, 2),
+        "copy, sec": round(copy_time, 2),
+        "speedup": round(read_sql_time / max(copy_time, 1e-9), 2),
+    }
+    print(result)
+
+    columns = list(copy_df.columns)
+    assert_frame_equal(
+        read_sql_df.astype(copy_df.dtypes.to_dict()).sort_values(columns, ignore_index=True),
+        copy_df.sort_values(columns, ignore_index=True),
+    )
+    return result
+
+
+# the queries of the calc engine on the fact: calc_tou._fact_where, check_calc_tou_can_start, fact_fully_loaded_slow
+FACT_INDEX_BENCHMARK_QUERIES = {
+    "calc_tou fact": (
+        "SELECT date_rep, wagon_num, rps_short, type_op, parking_fact FROM {table} "
+        "WHERE date_rep BETWEEN '2021-03-01' AND '2021-03-31' AND rps_short IN ('ПВ', 'ЦС') AND type_op IN ('ПГ')"
+    ),
+    "calc_tou fact by branch": (
+        "SELECT date_rep, wagon_num, parking_fact FROM {table} "
+        "WHERE date_rep BETWEEN '2021-03-01' AND '2021-05-31' AND org_id = 3"
+    ),
+    "check_calc_tou_can_start": (
+        "SELECT COUNT(distinct(date_rep)) FROM {table} WHERE date_rep BETWEEN '2021-01-01' AND '2021-12-31'"
+    ),
+    "fact_fully_loaded_slow": (
+        "SELECT count(distinct(date_rep)), date_part('month', date_rep) AS month_, date_part('year', date_rep) AS year_ "
+        "FROM {table} WHERE date_rep BETWEEN '2019-01-01' AND '2022-12-31' GROUP BY year_, month_"
+    ),
+}
+
+
+def benchmark_fact_indexes(
+    postgre_eng: Engine, rows: int = 50_000_000, table: str = "fact_index_benchmark", is_drop: bool = True
+) -> dict:
+    """
+    Latencies and plans of the calc queries on the synthetic fact-like table (4 years, rows are appended
+    in the order of date_rep as the loaders do) without indexes and with the indexes of the model Fact.
+    Example: python -m app.utils.benchmark 50000000
+    """
+    from app.core.models import Fact
+
+    def run_queries(stage: str) -> dict:
+        stage_result = {}
+        with postgre_eng.connect() as connection:
+            for name, sql_command in FACT_INDEX_BENCHMARK_QUERIES.items():
+                sql_command = sql_command.format(table=table)
+                connection.execute(sql_command)  # the cache is warmed up the same way for both stages
+                ts = perf_counter()
+                connection.execute(sql_command).fetchall()
+                stage_result[name] = round(perf_counter() - ts, 3)
+                plan = connection.execute(f"EXPLAIN (ANALYZE, BUFFERS) {sql_command}").fetchall()
+                print(f"--- {stage}: {name} ({stage_result[name]} sec)")
+                print("\n".join(el[0] for el in plan))
+        return stage_result
+
+    with postgre_eng.begin() as connection:
+        connection.execute(f"DROP TABLE IF EXISTS {table}")
+        connection.execute(
+            f"CREATE TABLE {table} (LIKE fact INCLUDING DEFAULTS) WITH (autovacuum_enabled = false)"
+            if postgre_eng.dialect.has_table(connection, "fact")
+            else f"CREATE TABLE {table} (id bigint, date_rep date, load_from varchar(10), st_code varchar(16), "
+            f"org_id numeric, type_op varchar(10), wagon_num bigint, rps_short varchar(10), parking_fact numeric)"
+        )
+        print(f"Filling {table} with {rows} rows")
+        # generate_series of bigint - i * 1461 overflows int4 after ~1.47M rows
+        connection.execute(
+            f"INSERT INTO {table} (id, date_rep, load_from, st_code, org_id, type_op, wagon_num, rps_short, "
+            f"parking_fact) "
+            f"SELECT i, '2019-01-01'::date + (i * 1461 / {rows})::int, "
+            f"(ARRAY['Cognos', 'SAP'])[1 + i % 2], (100000 + i % 5000)::text, i % 17, "
+            f"(ARRAY['ПГ', 'ВГ', 'ТР', 'РМ'])[1 + i % 4], 50000000 + i % 300000, "
+            f"(ARRAY['ПВ', 'ЦС', 'КР', 'ПЛ', 'ФТ'])[1 + i % 5], round((random() * 10)::numeric, 2) "
+            f"FROM generate_series(0::bigint, {rows - 1}) AS i"
+        )
+
+    def create_indexes(index_list: list):
+        # the same indexes as the model Fact has
+        with postgre_eng.begin() as connection:
+            for index in index_list:
+                columns = ", ".join(column.name for column in index.columns)
+                using = index.dialect_options["postgresql"]["using"] or "btree"
+                connection.execute(f"CREATE INDEX {index.name}_benchmark ON {table} USING {using} ({columns})")
+        with postgre_eng.connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT").execute(f"VACUUM ANALYZE {table}")
+
+    # before - only the single column indexes (org_id, wagon_num), after - with the date_rep ones
+    new_index_list = [index for index in Fact.__table__.indexes if "date_rep" in index.columns]
+    create_indexes([index for index in Fact.__table__.indexes if index not in new_index_list])
+    result = {"rows": rows, "before": run_queries("without date_rep indexes")}
+    ts = perf_counter()
+    create_indexes(new_index_list)
+    result["create indexes, sec"] = round(perf_counter() - ts, 2)
+    result["after"] = run_queries("with date_rep indexes")
+
+    if is_drop:
+        with postgre_eng.begin() as connection:
+            connection.execute(f"DROP TABLE IF EXISTS {table}")
+    for name in FACT_INDEX_BENCHMARK_QUERIES:
+        print(f"{name}: {result['before'][name]} -> {result['after'][name]} sec")
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    from app.core.database import EnginePostresql
+
+    benchmark_fact_indexes(EnginePostresql, rows=int(sys.argv[1]) if len(sys.argv) > 1 else 50_000_000)
@@ -0,0 +1,117 @@
+"""
+Disk cache of the aggregated facts of calc_tou (the result of aggregate_fact_df - before the names,
+the year projection and the seasonality).
+The key is the hash of the parameters, which change the aggregate, and of the versions of the fact months
+(fact_month_version, bumped by every load/delete of the fact), so a stale entry is never returned.
+"""
+import hashlib
+import json
+import os
+from datetime import date
+from typing import Optional
+
+import pandas as pd
+from pandas import DataFrame
+from sqlalchemy.engine import Engine
+
+from app.settings import PARSED_CONFIG
+from app.utils.utils_os import OsCls
+
+CACHE_FORMAT_VERSION = 1
+
+
+def get_cache_path() -> str:
+    cache_path = OsCls.join_path(OsCls.get_base_path(), "_cache")
+    OsCls.create_path_if_not_exist(cache_path)
+    cache_path = OsCls.join_path(cache_path, "calc_tou")
+    OsCls.create_path_if_not_exist(cache_path)
+    return cache_path
+
+
+def get_fact_month_versions(postgre_eng: Engine, date_from: date, date_to: date) -> list:
+    result = pd.read_sql(
+        f"SELECT month, version FROM fact_month_version "
+        f"WHERE month between date_trunc('month', '{date_from}'::date) and '{date_to}' ORDER BY month",
+        con=postgre_eng,
+    )
+    return [(str(el.month), int(el.version)) for el in result.itertuples(index=False)]
+
+
+def calc_cache_key(postgre_eng: Engine, parameters) -> str:
+    key = {
+        "format": CACHE_FORMAT_VERSION,
+        "date_from": str(parameters.date_from),
+        "date_to": str(parameters.date_to),
+        "branch_id": parameters.branch_id,
+        "rps_list": sorted(el.rps_short for el in parameters.rps_list),
+        "type_operation_list": sorted(el.type_operation.name for el in parameters.type_operation_list),
+        "station_list": sorted(el.st_code for el in parameters.station_list),
+        "group_data": parameters.group_data,
+        "exclude_from": str(parameters.exclude_from),
+        "exclude_to": str(parameters.exclude_to),
+        "exclude_volumes_traffic_less": str(parameters.exclude_volumes_traffic_less),
+        "fact_version": get_fact_month_versions(postgre_eng, parameters.date_from, parameters.date_to),
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get_calc_cache(key: str) -> Optional[DataFrame]:
+    if PARSED_CONFIG.CALC_CACHE_MAX_BYTES <= 0:
+        return None
+    file_name = OsCls.join_path(get_cache_path(), f"{key}.pkl")
+    try:
+        df = pd.read_pickle(file_name)
+    except (OSError, EOFError, ValueError):
+        return None
+    os.utime(file_name)  # the last usage for LRU
+    return df
+
+
+def put_calc_cache(key: str, df: DataFrame, date_from: date, date_to: date):
+    if PARSED_CONFIG.CALC_CACHE_MAX_BYTES <= 0:
+        return
+    cache_path = get_cache_path()
+    file_name = OsCls.join_path(cache_path, f"{key}.pkl")
+    df.to_pickle(file_name + ".tmp")
+    os.replace(file_name + ".tmp", file_name)
+    with open(OsCls.join_path(cache_path, f"{key}.json"), "w", encoding="utf-8") as file:
+        json.dump({"date_from": str(date_from), "date_to": str(date_to)}, file)
+    evict_calc_cache(PARSED_CONFIG.CALC_CACHE_MAX_BYTES)
+
+
+def evict_calc_cache(max_bytes: int):
+    """Removes the least recently used entries while the cache is bigger than max_bytes."""
+    cache_path = get_cache_path()
+    entries = []
+    for file_name in OsCls.get_files_list(cache_path, "*.pkl"):
+        stat = os.stat(file_name)
+        entries.append((stat.st_mtime, stat.st_size, file_name))
+    total_size = sum(el[1] for el in entries)
+    for _, size, file_name in sorted(entries):
+        if total_size <= max_bytes:
+            break
+        _remove_entry(file_name)
+        total_size -= size
+
+
+def invalidate_calc_cache(date_min: date, date_max: date) -> int:
+    """Removes the entries whose period intersects [date_min, date_max] (months of the fact were changed)."""
+    count = 0
+    for meta_file_name in OsCls.get_files_list(get_cache_path(), "*.json"):
+        try:
+            with open(meta_file_name, encoding="utf-8") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            continue
+        if meta["date_from"] <= str(date_max)[:10] and str(date_min)[:10] <= meta["date_to"]:
+            _remove_entry(meta_file_name[: -len(".json")] + ".pkl")
+            count += 1
+    return count
+
+
+def _remove_entry(file_name: str):
+    for el in (file_name, file_name[: -len(".pkl")] + ".json"):
+        try:
+            os.remove(el)
+        except FileNotFoundError:
+            pass
@@ -1,16 +1,37 @@
 import datetime
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from io import BytesIO
+from itertools import repeat
+from multiprocessing import get_context
+from typing import Optional
 
 import chardet
 import numpy as np
 import pandas as pd
+from fastapi import HTTPException
 from pandas import DataFrame
+from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
 from app.core import models
-from app.core.crud import get_calc_tou, get_season_coefficient_body_df, write_log
-from app.settings import CalcStateEnum, MyLogTypeEnum
-from app.utils.utils import table_writer, read_sql_with_chunk
+from app.core.database import SessionLocal
+from app.core.crud import (
+    check_calc_tou_projection,
+    delete_calc_tou_artifacts,
+    delete_file_storage,
+    get_calc_tou,
+    get_calc_tou_artifact,
+    get_file_storage_body,
+    get_season_coefficient_body_df,
+    save_calc_tou_artifact,
+    write_log,
+)
+from app.settings import EXCEL_MEDIA_TYPE, PARSED_CONFIG, CalcStateEnum, MyLogTypeEnum
+from app.utils.calc_cache import calc_cache_key, get_calc_cache, put_calc_cache
+from app.utils.grouped_stats import grouped_stats
+from app.utils.utils import optimize_memory_usage, read_sql_via_copy, table_writer_stream
 
 
 def calc_tou(db: Session, postgre_eng: Engine, komandor_eng: Engine, calc_tou_id: int, username: str = ""):
@@ -55,141 +76,54 @@ def calc_tou(db: Session, postgre_eng: Engine, komandor_eng: Engine, calc_tou_id
     #
     # return report_df, file_name
 
-    sql_command = f"select * from fact WHERE date_rep between '{parameters.date_from}' and '{parameters.date_to}'"
-    if parameters.branch_id:
-        sql_command += f" and org_id = '{parameters.branch_id}'"
-    if parameters.type_operation_list:
-        type_operation_list = [el.type_operation.name for el in parameters.type_operation_list]
-        type_operation_list = ", ".join(map(lambda x: f"'{x}'", type_operation_list))
-        sql_command += f" and type_op in ({type_operation_list})"
-    if parameters.rps_list:
-        rps_list = [el.rps_short for el in parameters.rps_list]
-        rps_list = ", ".join(map(lambda x: f"'{x}'", rps_list))
-        sql_command += f" and rps_short in ({rps_list})"
-    if parameters.station_list:
-        station_list = [el.st_code for el in parameters.station_list]
-        station_list = ", ".join(map(lambda x: f"'{x}'", station_list))
-        sql_command += f" and st_code in ({station_list})"
-
-    # report_df = pd.read_sql(sql_command, con=postgre_eng)
-    report_df = read_sql_with_chunk(postgre_eng, sql_command, 3000000)
-    # report_df = pd.read_sql("select * from fact WHERE date_rep between '2019-01-01' and '2019-12-31';", con=postgre_eng)
-    # report_df = pd.read_sql('select * from fact limit 10000;', con=postgre_eng)
-    # report_df = pd.read_sql('select * from fact;', con=postgre_eng)
-    report_df = add_info_by_station_cod(komandor_eng, report_df, parameters.group_data)
-    report_df = add_info_by_client_sap_id(postgre_eng, report_df)
-    report_df = add_info_cargo_group_go_short(komandor_eng, report_df)
-    columns_for_rename = {
-        "date_rep": "Отчётная дата",
-        "st_code": "Станция выполнения ГО код",
-        "st_name": "Станция выполнения ГО",
-        "rw_code": "Дорога выполнения ГО код",
-        "rw_short_name": "Дорога выполнения ГО Сокр",
-        "rw_name": "Дорога выполнения ГО Полн",
-        "org_id": "Филиал ГО ID",
-        "org_shortname": "Филиал ГО Сокр",
-        "org_name": "Филиал ГО Полн",
-        "client_sap_id": "Клиент ID SAP",
-        "client": "Клиент Наименование",
-        "type_op": "Операция тип",
-        "wagon_num": "Вагон №",
-        "rps_short": "РПС Наименование Сокр",
-        "cargo_group_num": "Группа груза ГО, номер",
-        "gg_name": "Группа груза ГО Наименование Сокр",
-        "parking_fact": "Простои Факт, ваг-сут",
-    }
-    column_for_group = [
-        "Период",
-        "РПС Наименование Сокр",
-        "Операция тип",
-        "Группа груза ГО, номер",
-        "Станция выполнения ГО код",
-        "Филиал ГО ID",
-        "Клиент ID SAP",
-    ]
-
-    if parameters.group_data == "РОС1С2КГ":
-        columns_for_rename.update(
-            {
-                "st_code_from": "Станция отправления код",
-                "st_name_from": "Станция отправления",
-                "st_code_to": "Станция назначения код",
-                "st_name_to": "Станция назначения",
-            }
-        )
-        column_for_group += ["Станция отправления код", "Станция назначения код"]
-
-    report_df = report_df[columns_for_rename.keys()]
-    report_df.rename(columns=columns_for_rename, inplace=True)
-    report_df["Отчётная дата"] = pd.to_datetime(report_df["Отчётная дата"], errors="coerce")
-    report_df["Период"] = report_df["Отчётная дата"].dt.strftime("%Y-%m")
-    report_df["Группа груза ГО, номер"].fillna(0, inplace=True)
-    # report_df.loc[report_df["Клиент Наименование"].isnull(), "Клиент Наименование"] = report_df["Клиент ID SAP"]
-    report_df.loc[:, "Сумма 'Вагон №' по ПРОСКГ, ед"] = report_df.groupby(column_for_group)["Отчётная дата"].transform(
-        "count"
-    )
-    report_df.loc[:, "Сумма 'Вагон №' по ПФРО, ед."] = report_df.groupby(
-        [
-            "Период",
-            "РПС Наименование Сокр",
-            "Операция тип",
-            "Филиал ГО ID",
-        ]
-    )["Отчётная дата"].transform("count")
-    report_df.loc[:, "Доля в ПФРО, %"] = (
-        report_df["Сумма 'Вагон №' по ПРОСКГ, ед"] / report_df["Сумма 'Вагон №' по ПФРО, ед."]
-    )
+    cache_key = calc_cache_key(postgre_eng, parameters)
+    report_df = get_calc_cache(cache_key)
+    if report_df is not None:
+        save_log(f"The aggregation by codes is taken from the cache - {report_df.shape[0]} rows.")
+    else:
+        if PARSED_CONFIG.CALC_TOU_WORKERS > 1:
+            report_df = aggregate_fact_parallel(postgre_eng, parameters, PARSED_CONFIG.CALC_TOU_WORKERS)
+        else:
+            report_df = load_fact_df(postgre_eng, parameters)
+            save_log(
+                f'Received {report_df.shape[0]} rows from the "fact", after applying a filter on calc_tou parameters.'
+            )
+            report_df = aggregate_fact_df(report_df, parameters.group_data)
+        save_log(f"After aggregation by codes - {report_df.shape[0]} rows.")
+        put_calc_cache(cache_key, report_df, parameters.date_from, parameters.date_to)
 
-    # Расчет финальной витрины
-    report_df = report_df[
-        (report_df["Простои Факт, ваг-сут"] > parameters.exclude_to)
-        & (report_df["Простои Факт, ваг-сут"] < parameters.exclude_from)
-        & (report_df["Доля в ПФРО, %"] > float(parameters.exclude_volumes_traffic_less))  # for TEST (need uncomment)
-    ]
+    report_df = decorate_aggregate_df(postgre_eng, komandor_eng, report_df, parameters.group_data)
 
-    save_log(f'Received {report_df.shape[0]} rows from the "fact", after applying a filter on calc_tou parameters.')
+    save_log(f"After aggregation - {report_df.shape[0]} rows, {report_df.shape[1]} cols.")
     # print(report_df.shape)
     # print(report_df.head())
 
-    column_for_group = [
-        "Филиал ГО Сокр",
-        "РПС Наименование Сокр",
-        "Операция тип",
-        "Группа груза ГО, номер",
-        "Группа груза ГО Наименование Сокр",
-        "Клиент ID SAP",
-        "Клиент Наименование",
-        "Станция выполнения ГО код",
-        "Станция выполнения ГО",
-    ]
-    if parameters.group_data == "РОС1С2КГ":
-        column_for_group += [
-            "Станция отправления код",
-            "Станция назначения код",
-            "Станция отправления",
-            "Станция назначения",
-        ]
+    save_aggregate_df(db, calc_tou_id, report_df)
 
-    # for TEST !!! (need comment)
-    # column_for_group += ["Доля в ПФРО, %", "Сумма 'Вагон №' по ПРОСКГ, ед", "Сумма 'Вагон №' по ПФРО, ед."]
+    season_coeffs_df = get_season_coefficient_body_df(postgre_eng, parameters.seasonal_coefficient_id)
+    report_df = project_report_df(report_df, parameters, season_coeffs_df)
+    save_log(
+        f"After add {parameters.amount_year_period} year periods and seasonal coefficients - "
+        f"{report_df.shape[0]} rows, {report_df.shape[1]} cols."
+    )
 
-    report_df = report_df.groupby(column_for_group).agg(
-        {
-            "Вагон №": [("Количество вагоноотправок, ед.", "count")],
-            "Простои Факт, ваг-сут": [
-                ("Простои Факт Среднее, ваг-сут", "mean"),
-                ("Q1", lambda x: x.quantile(0.25)),
-                ("Q2", lambda x: x.quantile(0.5)),
-                ("Мода", lambda x: pd.Series.mode(round(x, 2))[0]),
-            ],
-        }
+    save_result_df(db, calc_tou_id, report_df)
+    save_log(f"Saved result in DB (parquet - {report_df.shape[0]} rows, {report_df.shape[1]} cols).")
+
+    db.query(models.CalcTOU).filter(models.CalcTOU.id == calc_tou_id).update({"status": CalcStateEnum.done})
+    db.commit()
+    save_log(
+        f'Finished function (execution period {str(datetime.datetime.now() - time_start).split(".", 2)[0]})',
+        type_log=MyLogTypeEnum.FINISH,
     )
-    report_df.columns = report_df.columns.droplevel()
 
-    save_log(f"After aggregation - {report_df.shape[0]} rows, {report_df.shape[1]} cols.")
-    # print(report_df.shape)
-    # print(report_df.head())
 
+def project_report_df(report_df: DataFrame, parameters: models.CalcTOU, season_coeffs_df: DataFrame) -> DataFrame:
+    """
+    Builds the report from the aggregate (see decorate_aggregate_df): the target level, the years of the plan
+    period (base_year, amount_year_period) and the months by the seasonal coefficients.
+    """
+    report_df = report_df.copy()
     report_df["Объем < 32"] = report_df["Количество вагоноотправок, ед."] < 32
     report_df["Q2 > срзнач"] = report_df["Q2"] > report_df["Простои Факт Среднее, ваг-сут"]
 
@@ -214,46 +148,52 @@ def calc_tou(db: Session, postgre_eng: Engine, komandor_eng: Engine, calc_tou_id
         - 1
     )
 
-    report_df[f"{parameters.base_year}г"] = report_df["drop_Базовый Уровень на начало расчёта"]
+    year_columns = [f"{parameters.base_year + i}г" for i in range(parameters.amount_year_period + 1)]
+    year_matrix = build_year_matrix(
+        report_df["drop_Базовый Уровень на начало расчёта"].to_numpy(dtype="float64"),
+        report_df["Процентная годовая динамика 75%"].to_numpy(dtype="float64"),
+        parameters.amount_year_period,
+    )
     # report_df["Базовый Уровень на начало расчёта"] = report_df["drop_Базовый Уровень на начало расчёта"]
-    report_df = report_df.drop(columns=["drop_Базовый Уровень на начало расчёта"])
-
-    prev_tou = report_df[f"{parameters.base_year}г"]
-    for i in range(parameters.amount_year_period + 1):
-        if i == 0:
-            report_df[f"{parameters.base_year + i}г"] = prev_tou
-        else:
-            report_df[f"{parameters.base_year + i}г"] = (
-                prev_tou + prev_tou * report_df["Процентная годовая динамика 75%"]
-            )
-        prev_tou = report_df[f"{parameters.base_year + i}г"]
+    report_df = pd.concat(
+        [
+            report_df.drop(columns=["drop_Базовый Уровень на начало расчёта"]),
+            DataFrame(year_matrix, index=report_df.index, columns=year_columns),
+        ],
+        axis=1,
+    )
     # report_df["Целевое ТОУ на конец планового периода"] = report_df[f"{parameters.base_year + parameters.amount_year_period}г"]
 
-    save_log(
+    print(
         f"After add {parameters.amount_year_period} year periods - "
         f"{report_df.shape[0]} rows, {report_df.shape[1]} cols."
     )
     # print(report_df.shape)
     # print(report_df.head())
 
-    season_coeffs_df = get_season_coefficient_body_df(postgre_eng, parameters.seasonal_coefficient_id)
-    season_coeffs_df.rename(
-        columns={"rps_short": "РПС Наименование Сокр", "type_operation": "Операция тип"}, inplace=True
+    season_coeffs_df = season_coeffs_df.rename(
+        columns={"rps_short": "РПС Наименование Сокр", "type_operation": "Операция тип"}
     )
 
     report_df = report_df.reset_index().merge(season_coeffs_df, on=["РПС Наименование Сокр", "Операция тип"])
 
-    for i in range(parameters.amount_year_period + 1):
-        for j in range(1, 13):
-            col_name = f"{parameters.base_year + i}-{j:02d}"
-            report_df[col_name] = report_df[f"{parameters.base_year + i}г"] * report_df[f"СК{j:02d}"]
-
-    report_df = report_df.drop(
-        columns=[c for c in report_df.columns if c[:2] == "СК"]
-        # columns=[c for c in report_df.columns if c[:2] == "СК"] + ["БУ+0г", f"БУ+{parameters.amount_year_period}г"]
+    season_columns = [f"СК{j:02d}" for j in range(1, 13)]
+    month_columns = [
+        f"{parameters.base_year + i}-{j:02d}" for i in range(parameters.amount_year_period + 1) for j in range(1, 13)
+    ]
+    month_tensor = build_month_tensor(
+        report_df[year_columns].to_numpy(dtype="float64"), report_df[season_columns].to_numpy(dtype="float64")
+    )
+    report_df = pd.concat(
+        [
+            report_df.drop(columns=[c for c in report_df.columns if c[:2] == "СК"]),
+            # columns=[c for c in report_df.columns if c[:2] == "СК"] + ["БУ+0г", f"БУ+{parameters.amount_year_period}г"]
+            DataFrame(month_tensor.reshape(len(report_df), -1), index=report_df.index, columns=month_columns),
+        ],
+        axis=1,
     )
 
-    save_log(f"After merged seasonal coefficients: {report_df.shape[0]} rows, {report_df.shape[1]} cols.")
+    print(f"After merged seasonal coefficients: {report_df.shape[0]} rows, {report_df.shape[1]} cols.")
     # print(report_df.shape)
     # print(report_df.head())
     # df_to_new_table(db=db, engine=postgre_eng, df=report_df, table_name='calc_tou_result')
@@ -282,29 +222,354 @@ def calc_tou(db: Session, postgre_eng: Engine, komandor_eng: Engine, calc_tou_id
         )
 
     report_df.insert(0, "База", f"{parameters.id}: {parameters.name}")
+    return report_df
+
+
+def build_year_matrix(base_level: np.ndarray, annual_dynamics: np.ndarray, amount_year_period: int) -> np.ndarray:
+    """
+    Levels of the years of the plan period: (n × amount_year_period+1), the column 0 is the base year,
+    each next year = previous + previous * annual_dynamics.
+    """
+    year_matrix = np.empty((len(base_level), amount_year_period + 1), dtype="float64")
+    year_matrix[:, 0] = base_level
+    for i in range(1, amount_year_period + 1):
+        year_matrix[:, i] = year_matrix[:, i - 1] + year_matrix[:, i - 1] * annual_dynamics
+    return year_matrix
+
+
+def build_month_tensor(year_matrix: np.ndarray, season_matrix: np.ndarray) -> np.ndarray:
+    """
+    Levels of the months: (n × years × 12) = level of the year * seasonal coefficient of the month.
+    season_matrix - (n × 12) coefficients of the rows (СК01..СК12).
+    """
+    return year_matrix[:, :, np.newaxis] * season_matrix[:, np.newaxis, :]
+
+
+RESULT_FILE_TYPES = {"xlsx": EXCEL_MEDIA_TYPE, "csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+def save_aggregate_df(db: Session, calc_tou_id: int, report_df: DataFrame):
+    stream = BytesIO()
+    report_df.to_pickle(stream, compression=None)
+    save_calc_tou_artifact(db, calc_tou_id, "aggregate", f"calc_tou_{calc_tou_id}_aggregate.pickle", stream.getvalue())
+
+
+def load_aggregate_df(db: Session, calc_tou_id: int) -> DataFrame:
+    db_file_storage = get_calc_tou_artifact(db, calc_tou_id, "aggregate")
+    if db_file_storage is None:
+        raise HTTPException(
+            status_code=422,
+            detail=f"CalcTOU with ID={calc_tou_id} has no stored aggregate (it must be calculated again)",
+        )
+    return pd.read_pickle(BytesIO(get_file_storage_body(db, db_file_storage)), compression=None)
+
+
+def save_result_df(db: Session, calc_tou_id: int, report_df: DataFrame, calc_tou_update: Optional[dict] = None):
+    """
+    The result is stored as Parquet only (typed columns, zstd), xlsx/csv are rendered from it on the first download
+    (see render_calc_tou_result) - the previous renders are stale now.
+    CalcTOU.file_storage_id is empty till the xlsx is rendered.
+    calc_tou_update - the parameters of CalcTOU which are saved in the same transaction as the result.
+    """
+    stream = BytesIO()
+    report_df.to_parquet(stream, engine="pyarrow", compression="zstd", index=False)
+    save_calc_tou_artifact(
+        db, calc_tou_id, "result", f"calc_tou_{calc_tou_id}_result.parquet", stream.getvalue(), is_commit=False
+    )
+    delete_calc_tou_artifacts(
+        db,
+        calc_tou_id,
+        [f"result_{file_type}" for file_type in RESULT_FILE_TYPES if file_type != "parquet"],
+        is_commit=False,
+    )
+    db_calc_tou = db.query(models.CalcTOU).filter(models.CalcTOU.id == calc_tou_id).first()
+    # the xlsx of the calculation saved before the artifacts
+    delete_file_storage(db, db_calc_tou.file_storage_id)
+    db_calc_tou.file_storage_id = None
+    for key, value in (calc_tou_update or {}).items():
+        setattr(db_calc_tou, key, value)
+    db.commit()
+
+
+def get_calc_tou_result(db: Session, calc_tou_id: int, file_type: str = "xlsx") -> Optional[models.FileStorage]:
+    """Returns the result of the calculation in file_type, None - it is not rendered yet."""
+    if file_type not in RESULT_FILE_TYPES:
+        raise HTTPException(status_code=400, detail=f"file type not allowed (only {', '.join(RESULT_FILE_TYPES)})")
+    db_result = get_calc_tou_artifact(db, calc_tou_id, "result")
+    if db_result is None:
+        raise HTTPException(status_code=404, detail=f"CalcTOU with ID={calc_tou_id} has no result")
+    if file_type == "parquet":
+        return db_result
+    return get_calc_tou_artifact(db, calc_tou_id, f"result_{file_type}")
+
+
+def render_calc_tou_result(
+    db: Session,
+    calc_tou_id: int,
+    file_type: str = "xlsx",
+    report_df: Optional[DataFrame] = None,
+    is_replace: bool = True,
+) -> models.FileStorage:
+    """
+    Renders the result of the calculation (report_df - None: it is read from Parquet) to file_type,
+    the file is streamed into file_storage by chunks and cached as the artifact "result_{file_type}".
+    is_replace=False - the render saved in parallel is kept (see save_calc_tou_artifact).
+    """
+    db_file_storage = get_calc_tou_result(db, calc_tou_id, file_type)
+    if file_type == "parquet" or (db_file_storage is not None and not is_replace):
+        return db_file_storage
+    parameters = get_calc_tou(db, calc_tou_id)
+    if report_df is None:
+        db_result = get_calc_tou_artifact(db, calc_tou_id, "result")
+        report_df = pd.read_parquet(BytesIO(get_file_storage_body(db, db_result)), engine="pyarrow")
     # report_df = report_df.round(2)
     # report_df.to_excel("report_tou_2019.xlsx", index=False)
-    # chunksize = 20000
-    # report_df.to_sql(
-    #     "calc_tou_result", if_exists="replace", index_label="id", con=postgre_eng, chunksize=chunksize, method="multi"
-    # )
-    file_name = f'report_tou_{parameters.date_from.strftime("%Y-%m")}_{parameters.date_to.strftime("%Y-%m")}.xlsx'
-    save_log(f"Started saving result in DB ({file_name} - {report_df.shape[0]} rows, {report_df.shape[1]} cols).")
+    file_name = (
+        f'report_tou_{parameters.date_from.strftime("%Y-%m")}_{parameters.date_to.strftime("%Y-%m")}.{file_type}'
+    )
+    print(f"Started rendering result ({file_name} - {report_df.shape[0]} rows, {report_df.shape[1]} cols).")
+    return save_calc_tou_artifact(
+        db,
+        calc_tou_id,
+        f"result_{file_type}",
+        file_name,
+        table_writer_stream(dataframes={f"base year {parameters.base_year}": report_df}, param=file_type),
+        is_replace=is_replace,
+    )
 
-    stream = table_writer(dataframes={f"base year {parameters.base_year}": report_df}, param="xlsx")
-    db_file_storage = models.FileStorage(file_name=file_name, file_body=stream.read())
-    db.add(db_file_storage)
-    db.commit()
 
-    db.query(models.CalcTOU).filter(models.CalcTOU.id == calc_tou_id).update(
-        {"file_storage_id": db_file_storage.id, "status": CalcStateEnum.done}
+def render_calc_tou_result_background(calc_tou_id: int, file_type: str = "xlsx"):
+    # the task of BackgroundTasks - the own session (the session of the request is closed after the response)
+    db = SessionLocal()
+    try:
+        render_calc_tou_result(db, calc_tou_id, file_type, is_replace=False)
+    finally:
+        db.close()
+
+
+def reproject_calc_tou(
+    db: Session,
+    postgre_eng: Engine,
+    calc_tou_id: int,
+    username: str = "",
+    base_year: Optional[int] = None,
+    amount_year_period: Optional[int] = None,
+    seasonal_coefficient_id: Optional[int] = None,
+):
+    """
+    Rebuilds the result of the finished calculation by its stored aggregate - only base_year, amount_year_period
+    and seasonal_coefficient_id (None - the saved one) are applied again, "fact" is not read.
+    The new parameters are saved together with the new result - the failed re-projection changes nothing.
+    """
+    time_start = datetime.datetime.now()
+    calc_tou_update = check_calc_tou_projection(db, calc_tou_id, base_year, amount_year_period, seasonal_coefficient_id)
+    parameters = get_calc_tou(db, calc_tou_id)
+    try:
+        for key, value in calc_tou_update.items():
+            setattr(parameters, key, value)
+        report_df = load_aggregate_df(db, calc_tou_id)
+
+        season_coeffs_df = get_season_coefficient_body_df(postgre_eng, parameters.seasonal_coefficient_id)
+        report_df = project_report_df(report_df, parameters, season_coeffs_df)
+        save_result_df(db, calc_tou_id, report_df, calc_tou_update)
+    except Exception:
+        db.rollback()
+        raise
+    write_log(
+        db=db,
+        parent_id=calc_tou_id,
+        parent_name="calc_tou",
+        type=MyLogTypeEnum.FINISH,
+        msg=f"Re-projected (base year {parameters.base_year}, {parameters.amount_year_period} year periods, "
+        f"seasonal coefficients ID={parameters.seasonal_coefficient_id}) - {report_df.shape[0]} rows, "
+        f'execution period {str(datetime.datetime.now() - time_start).split(".", 2)[0]}',
+        username=username,
     )
-    db.commit()
-    save_log(
-        f'Finished function (execution period {str(datetime.datetime.now() - time_start).split(".", 2)[0]})',
-        type_log=MyLogTypeEnum.FINISH,
+    return {"message": f"The result of the calculation is rebuilt ({report_df.shape[0]} rows)"}
+
+
+def load_fact_df(postgre_eng: Engine, parameters: models.CalcTOU) -> DataFrame:
+    """Reads from "fact" the rows of the calculation (see build_fact_sql) in the compact form."""
+    return read_fact_df(postgre_eng, build_fact_sql(parameters))
+
+
+def read_fact_df(postgre_eng: Engine, sql_command: str) -> DataFrame:
+    # report_df = pd.read_sql(sql_command, con=postgre_eng)
+    # report_df = read_sql_with_chunk(postgre_eng, sql_command, 3000000)
+    report_df = read_sql_via_copy(postgre_eng, sql_command, models.Fact)
+    for column in report_df.columns.intersection(CATEGORY_COLUMNS):
+        report_df[column] = report_df[column].astype("category")
+    # "parking_fact" stays float64 - the statistics must not change
+    return optimize_memory_usage(report_df, is_downcast_float=False)
+
+
+def aggregate_fact_df(report_df: DataFrame, group_data: str) -> DataFrame:
+    """
+    Aggregates the facts by the codes only (РПС, Операция тип, Группа груза, Клиент, Станции).
+    The names are determined by the codes, so the statistics are the same as for the grouping with the names.
+    Rows with an empty code (and an unknown cargo group - it has no name) are not included in any group.
+    """
+    code_columns = ["rps_short", "type_op", "cargo_group_num", "client_sap_id", "st_code"]
+    if group_data == "РОС1С2КГ":
+        code_columns += ["st_code_from", "st_code_to"]
+    report_df = grouped_stats(report_df, code_columns, "parking_fact", "wagon_num").reset_index()
+    # the codes are back to the plain values (the names are merged on object columns) and in the order of groupby
+    # on them (groupby with observed=True does not sort several categorical keys)
+    for column in report_df.select_dtypes(include="category").columns:
+        report_df[column] = report_df[column].astype(object)
+    return report_df.sort_values(code_columns, ignore_index=True)
+
+
+def aggregate_fact_parallel(postgre_eng: Engine, parameters: models.CalcTOU, workers: int) -> DataFrame:
+    """
+    The same as aggregate_fact_df(load_fact_df(...)), but the facts are read and aggregated by the shards
+    (РПС, Операция тип) in the pool of processes. All the window functions of build_fact_sql and the groups
+    are inside one (РПС, Операция тип), so the shards are independent and the result is just their union.
+    """
+    shards = get_fact_shards(postgre_eng, parameters)
+    print(f"calc_tou: {len(shards)} shards on {min(workers, len(shards))} processes")
+    if len(shards) < 2:
+        return aggregate_fact_df(load_fact_df(postgre_eng, parameters), parameters.group_data)
+
+    sql_list = [build_fact_sql(parameters, shard) for shard in shards]
+    with ProcessPoolExecutor(max_workers=min(workers, len(shards)), mp_context=get_context("spawn")) as executor:
+        result = list(executor.map(_aggregate_shard, sql_list, repeat(parameters.group_data)))
+    return pd.concat(result, ignore_index=True)
+
+
+def get_fact_shards(postgre_eng: Engine, parameters: models.CalcTOU) -> list[tuple]:
+    """Returns the list of (rps_short, type_op) which are present in "fact" for the calculation."""
+    sql_command = f"select distinct rps_short, type_op from fact where {_fact_where(parameters)}"
+    shards_df = pd.read_sql(sql_command, con=postgre_eng).dropna()
+    return list(shards_df.itertuples(index=False, name=None))
+
+
+def _aggregate_shard(sql_command: str, group_data: str) -> DataFrame:
+    # it is executed in the separate process - the own connection to Postgres
+    postgre_eng = create_engine(PARSED_CONFIG.database.dsn)
+    try:
+        return aggregate_fact_df(read_fact_df(postgre_eng, sql_command), group_data)
+    finally:
+        postgre_eng.dispose()
+
+
+def decorate_aggregate_df(
+    postgre_eng: Engine, komandor_eng: Engine, report_df: DataFrame, group_data: str
+) -> DataFrame:
+    """
+    Adds the names of stations/branches, clients and cargo groups to the aggregated rows
+    and returns the frame indexed by the grouping columns of the report (the same order as groupby gives).
+    """
+    report_df = add_info_by_station_cod(komandor_eng, report_df, group_data)
+    report_df = add_info_by_client_sap_id(postgre_eng, report_df)
+    report_df = add_info_cargo_group_go_short(komandor_eng, report_df)
+    columns_for_rename = {
+        "org_shortname": "Филиал ГО Сокр",
+        "rps_short": "РПС Наименование Сокр",
+        "type_op": "Операция тип",
+        "cargo_group_num": "Группа груза ГО, номер",
+        "gg_name": "Группа груза ГО Наименование Сокр",
+        "client_sap_id": "Клиент ID SAP",
+        "client": "Клиент Наименование",
+        "st_code": "Станция выполнения ГО код",
+        "st_name": "Станция выполнения ГО",
+    }
+    if group_data == "РОС1С2КГ":
+        columns_for_rename.update(
+            {
+                "st_code_from": "Станция отправления код",
+                "st_code_to": "Станция назначения код",
+                "st_name_from": "Станция отправления",
+                "st_name_to": "Станция назначения",
+            }
+        )
+    column_for_group = list(columns_for_rename.values())
+    columns_for_rename.update(
+        {
+            "count": "Количество вагоноотправок, ед.",
+            "mean": "Простои Факт Среднее, ваг-сут",
+            0.25: "Q1",
+            0.5: "Q2",
+            "mode": "Мода",
+        }
     )
-    # return report_df, file_name
+
+    report_df = report_df[columns_for_rename.keys()].rename(columns=columns_for_rename)
+    # groupby does not include the rows with an empty name (the code is absent in the reference)
+    report_df = report_df.dropna(subset=column_for_group)
+    # the same name can come from several identical rows of the reference - one group as groupby gives
+    report_df = report_df.drop_duplicates(subset=column_for_group)
+    return report_df.set_index(column_for_group).sort_index()
+
+
+# only the columns of "fact" which are used by the calculation
+FACT_CALC_COLUMNS = ["st_code", "client_sap_id", "type_op", "wagon_num", "rps_short", "cargo_group_num", "parking_fact"]
+# low-cardinality string codes which are kept as categoricals from the read of "fact" till the aggregation
+CATEGORY_COLUMNS = ["st_code", "st_code_from", "st_code_to", "client_sap_id", "type_op", "rps_short"]
+
+
+def build_fact_sql(parameters: models.CalcTOU, shard: tuple = None) -> str:
+    """
+    Returns SQL that selects from "fact" only the rows that survive the calc_tou filters.
+    "Сумма 'Вагон №' по ПРОСКГ" and "Сумма 'Вагон №' по ПФРО" are calculated by window functions over the
+    whole period (before the outlier filter), then the outliers and the insignificant volumes are excluded.
+    Rows with an empty grouping key are skipped (pandas groupby drops them as well).
+    shard - (rps_short, type_op) to read only one part of the facts (see aggregate_fact_parallel).
+    """
+    where = _fact_where(parameters)
+    if shard:
+        where += f" and rps_short = '{shard[0]}' and type_op = '{shard[1]}'"
+
+    partition_pfro = ["date_trunc('month', date_rep)", "rps_short", "type_op", "org_id"]
+    partition_proskg = partition_pfro + ["coalesce(cargo_group_num, 0)", "st_code", "client_sap_id"]
+    if parameters.group_data == "РОС1С2КГ":
+        partition_proskg += ["st_code_from", "st_code_to"]
+    key_not_null = " and ".join(f"{col} is not null" for col in partition_proskg if "(" not in col)
+
+    columns = FACT_CALC_COLUMNS + (["st_code_from", "st_code_to"] if parameters.group_data == "РОС1С2КГ" else [])
+
+    return (
+        f"select {', '.join(columns)} from ("
+        f"select *, "
+        f"count(*) over (partition by {', '.join(partition_proskg)}) as amount_proskg, "
+        f"count(*) over (partition by {', '.join(partition_pfro)}) as amount_pfro "
+        f"from fact where {where}"
+        f") as t where {key_not_null} "
+        f"and parking_fact::float8 {_float8_compare(parameters.exclude_to, '>')} "
+        f"and parking_fact::float8 {_float8_compare(parameters.exclude_from, '<')} "
+        f"and amount_proskg::float8 / amount_pfro > {float(parameters.exclude_volumes_traffic_less)!r}::float8"
+    )
+
+
+def _fact_where(parameters: models.CalcTOU) -> str:
+    where = f"date_rep between '{parameters.date_from}' and '{parameters.date_to}'"
+    if parameters.branch_id:
+        where += f" and org_id = '{parameters.branch_id}'"
+    if parameters.type_operation_list:
+        type_operation_list = [el.type_operation.name for el in parameters.type_operation_list]
+        type_operation_list = ", ".join(map(lambda x: f"'{x}'", type_operation_list))
+        where += f" and type_op in ({type_operation_list})"
+    if parameters.rps_list:
+        rps_list = [el.rps_short for el in parameters.rps_list]
+        rps_list = ", ".join(map(lambda x: f"'{x}'", rps_list))
+        where += f" and rps_short in ({rps_list})"
+    if parameters.station_list:
+        station_list = [el.st_code for el in parameters.station_list]
+        station_list = ", ".join(map(lambda x: f"'{x}'", station_list))
+        where += f" and st_code in ({station_list})"
+
+    return where
+
+
+def _float8_compare(value: Decimal, operator: str) -> str:
+    # pandas compares float64 "parking_fact" with Decimal parameter exactly (float vs Decimal in python),
+    # so the bound is moved to the nearest float8 to get the same result in Postgres
+    bound = float(value)
+    if operator == ">" and Decimal(bound) > value:
+        operator = ">="
+    elif operator == "<" and Decimal(bound) < value:
+        operator = "<="
+    return f"{operator} {bound!r}::float8"
 
 
 def get_file_encoding(file_name):
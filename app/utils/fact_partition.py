@@ -0,0 +1,275 @@
+"""
+Partitions of the table "fact": RANGE by month of date_rep (fact_y2022m01), each month is LIST-partitioned
+by load_from (fact_y2022m01_cognos, fact_y2022m01_sap, fact_y2022m01_other).
+The months are created on demand before a load (create_fact_partitions), the overwrite of a period
+truncates the leaf partitions of the fully covered months and deletes only in the partial ones
+(overwrite_fact_partitions). The overwrite via the unlogged staging table (create_fact_staging,
+replace_fact_from_staging) swaps the leaf partitions of the fully covered months in one transaction.
+The calc queries filter by the date literals - the planner prunes the months.
+
+Migration of the existing (not partitioned) table and its indexes: python -m app.utils.fact_partition
+"""
+from uuid import uuid4
+
+import pandas as pd
+from fastapi import HTTPException
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+FACT_LOAD_FROM_PARTITIONS = {"Cognos": "cognos", "SAP": "sap"}
+FACT_OTHER_PARTITION = "other"
+
+
+def get_months(date_min, date_max) -> list[pd.Timestamp]:
+    """First days of the months of [date_min, date_max]."""
+    if pd.isnull(date_min) or pd.isnull(date_max):
+        return []
+    return list(pd.date_range(pd.Timestamp(date_min).to_period("M").to_timestamp(), pd.Timestamp(date_max), freq="MS"))
+
+
+def get_fact_partition_name(month: pd.Timestamp, load_from: str = None) -> str:
+    name = f"fact_y{month.year}m{month.month:02d}"
+    if load_from is None:
+        return name
+    return f"{name}_{FACT_LOAD_FROM_PARTITIONS.get(load_from, FACT_OTHER_PARTITION)}"
+
+
+def is_fact_partitioned(db: Session) -> bool:
+    return bool(db.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'fact'::regclass").first())
+
+
+def is_table_exist(db: Session, table_name: str) -> bool:
+    return db.execute(f"SELECT to_regclass('{table_name}')").scalar() is not None
+
+
+def create_fact_partitions(db: Session, date_min, date_max):
+    """Creates the missing month partitions of [date_min, date_max] (must be called before the load of facts)."""
+    if not is_fact_partitioned(db):
+        return
+    for month in get_months(date_min, date_max):
+        name = get_fact_partition_name(month)
+        if is_table_exist(db, name):
+            continue
+        next_month = month + pd.offsets.MonthBegin(1)
+        db.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF fact "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month:%Y-%m-%d}') PARTITION BY LIST (load_from)"
+        )
+        for load_from, suffix in FACT_LOAD_FROM_PARTITIONS.items():
+            db.execute(f"CREATE TABLE IF NOT EXISTS {name}_{suffix} PARTITION OF {name} FOR VALUES IN ('{load_from}')")
+        db.execute(f"CREATE TABLE IF NOT EXISTS {name}_{FACT_OTHER_PARTITION} PARTITION OF {name} DEFAULT")
+        print(f"Created partition {name}")
+    db.commit()
+
+
+def overwrite_fact_partitions(db: Session, date_min, date_max, load_from: str) -> int:
+    """
+    Removes the facts of load_from for [date_min, date_max], returns the amount of the removed records.
+    The fully covered months are truncated (the leaf partition of load_from only), in the partial months
+    the rows are deleted by the condition - in both cases nothing is read into python.
+    """
+    if pd.isnull(date_min) or pd.isnull(date_max):
+        return 0
+    date_min, date_max = pd.Timestamp(date_min), pd.Timestamp(date_max)
+    if not is_fact_partitioned(db):
+        amount = db.execute(
+            f"DELETE FROM fact WHERE load_from = '{load_from}' "
+            f"AND date_rep BETWEEN '{date_min:%Y-%m-%d}' AND '{date_max:%Y-%m-%d}'"
+        ).rowcount
+        db.commit()
+        return amount
+
+    amount = 0
+    for month in get_months(date_min, date_max):
+        name = get_fact_partition_name(month, load_from)
+        if not is_table_exist(db, name):
+            continue
+        month_end = month + pd.offsets.MonthEnd(0)
+        if date_min <= month and month_end <= date_max and load_from in FACT_LOAD_FROM_PARTITIONS:
+            amount += db.execute(f"SELECT count(*) FROM {name}").scalar()
+            db.execute(f"TRUNCATE TABLE {name}")
+        else:
+            amount += db.execute(
+                f"DELETE FROM {name} WHERE load_from = '{load_from}' "
+                f"AND date_rep BETWEEN '{max(date_min, month):%Y-%m-%d}' AND '{min(date_max, month_end):%Y-%m-%d}'"
+            ).rowcount
+    db.commit()
+    return amount
+
+
+def create_fact_staging(db: Session) -> str:
+    """Creates the unlogged table with the columns (and the id sequence) of "fact", returns its name."""
+    name = f"fact_stage_{uuid4().hex[:12]}"
+    db.execute(f"CREATE UNLOGGED TABLE {name} (LIKE fact INCLUDING DEFAULTS)")
+    db.commit()
+    return name
+
+
+def drop_fact_staging(db: Session, staging: str):
+    db.rollback()
+    db.execute(f"DROP TABLE IF EXISTS {staging}")
+    db.commit()
+
+
+def validate_fact_staging(db: Session, staging: str, rows: int, periods: list[tuple], load_from: str):
+    """Checks that the staging has all rows, only of load_from and only in the periods [(date_min, date_max), ...]."""
+    in_periods = " OR ".join(
+        f"date_rep BETWEEN '{pd.Timestamp(date_min):%Y-%m-%d}' AND '{pd.Timestamp(date_max):%Y-%m-%d}'"
+        for date_min, date_max in periods
+    )
+    amount, amount_other, amount_outside = db.execute(
+        f"SELECT count(*), count(*) FILTER (WHERE load_from IS DISTINCT FROM '{load_from}'), "
+        f"count(*) FILTER (WHERE date_rep IS NULL OR NOT ({in_periods})) FROM {staging}"
+    ).first()
+    errors = []
+    if amount != rows:
+        errors.append(f"{amount} rows instead of {rows}")
+    if amount_other:
+        errors.append(f"{amount_other} rows not of {load_from}")
+    if amount_outside:
+        errors.append(f"{amount_outside} rows out of the periods of the load")
+    if errors:
+        raise HTTPException(status_code=422, detail=f"The load of {load_from} is not saved: {', '.join(errors)}")
+
+
+def replace_fact_from_staging(db: Session, staging: str, periods: list[tuple], load_from: str) -> int:
+    """
+    Replaces the facts of load_from in the periods by the rows of the staging, returns the amount of the removed
+    records. The leaf partitions of the fully covered months are built from the staging in advance, then one
+    transaction swaps them (detach/attach) and replaces the rows of the partial months - the readers see either
+    the old or the new facts of the whole load, the failed load leaves the old facts.
+    """
+    from app.core.models import Fact
+
+    columns = ", ".join(column.name for column in Fact.__table__.columns)
+    is_partitioned = is_fact_partitioned(db)
+    swap_months, partial_periods = [], []
+    for date_min, date_max in periods:
+        date_min, date_max = pd.Timestamp(date_min), pd.Timestamp(date_max)
+        if not is_partitioned or load_from not in FACT_LOAD_FROM_PARTITIONS:
+            partial_periods.append(("fact", date_min, date_max))
+            continue
+        for month in get_months(date_min, date_max):
+            month_end = month + pd.offsets.MonthEnd(0)
+            if date_min <= month and month_end <= date_max:
+                swap_months.append(month)
+            else:
+                name = get_fact_partition_name(month, load_from)
+                partial_periods.append((name, max(date_min, month), min(date_max, month_end)))
+
+    # the prepared leaves are named by the load - the parallel loads of the same month do not drop them
+    suffix = uuid4().hex[:12]
+    new_names = []
+    try:
+        for month in swap_months:
+            new_names.append(_build_fact_partition(db, staging, columns, month, load_from, suffix))
+
+        old_names = [get_fact_partition_name(month, load_from) for month in swap_months]
+        # the parallel swaps of the same months wait for each other (in the order of months - without deadlocks)
+        for name in sorted(old_names):
+            db.execute(f"SELECT pg_advisory_xact_lock(hashtext('{name}'))")
+        # the old leaves are counted before the locks of the swap
+        amount = sum(db.execute(f"SELECT count(*) FROM {name}").scalar() for name in old_names)
+        for table, date_min, date_max in partial_periods:
+            condition = f"date_rep BETWEEN '{date_min:%Y-%m-%d}' AND '{date_max:%Y-%m-%d}'"
+            amount += db.execute(f"DELETE FROM {table} WHERE load_from = '{load_from}' AND {condition}").rowcount
+            db.execute(f"INSERT INTO fact ({columns}) SELECT {columns} FROM {staging} WHERE {condition}")
+        for month, new_name in zip(swap_months, new_names):
+            parent, name = get_fact_partition_name(month), get_fact_partition_name(month, load_from)
+            db.execute(f"ALTER TABLE {parent} DETACH PARTITION {name}")
+            db.execute(f"ALTER TABLE {parent} ATTACH PARTITION {new_name} FOR VALUES IN ('{load_from}')")
+            db.execute(f"ALTER TABLE {new_name} DROP CONSTRAINT {new_name}_bounds")
+            db.execute(f"DROP TABLE {name}")
+            db.execute(f"ALTER TABLE {new_name} RENAME TO {name}")
+        db.commit()
+        print(f"Replaced {amount} facts of {load_from} ({len(swap_months)} partitions swapped)")
+        return amount
+    except Exception:
+        db.rollback()
+        for name in new_names:
+            db.execute(f"DROP TABLE IF EXISTS {name}")
+        db.commit()
+        raise
+
+
+def _build_fact_partition(
+    db: Session, staging: str, columns: str, month: pd.Timestamp, load_from: str, suffix: str
+) -> str:
+    # the new leaf partition is filled outside of the swap transaction, the check of the bounds
+    # lets ATTACH PARTITION skip the scan of the table
+    name = get_fact_partition_name(month, load_from)
+    new_name = f"{name}_{suffix}"
+    next_month = month + pd.offsets.MonthBegin(1)
+    bounds = (
+        f"date_rep IS NOT NULL AND date_rep >= '{month:%Y-%m-%d}' AND date_rep < '{next_month:%Y-%m-%d}' "
+        f"AND load_from IS NOT NULL AND load_from = '{load_from}'"
+    )
+    db.execute(f"CREATE TABLE {new_name} (LIKE {name} INCLUDING ALL)")
+    db.execute(f"INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {staging} WHERE {bounds}")
+    db.execute(f"ALTER TABLE {new_name} ADD CONSTRAINT {new_name}_bounds CHECK ({bounds})")
+    db.commit()
+    return new_name
+
+
+def migrate_fact_to_partitioned(engine: Engine):
+    """
+    Converts the existing heap table "fact" to the partitioned one: fact -> fact_old, the new "fact" is created
+    by the model, the rows are copied month by month, fact_old is dropped in the end only if the row counts
+    of fact and fact_old are equal (otherwise fact_old is kept for the check).
+    """
+    from app.core.models import Fact
+
+    db = Session(bind=engine)
+    try:
+        if not is_table_exist(db, "fact") or is_fact_partitioned(db):
+            print("Table fact is already partitioned (or absent)")
+            return
+        rows_without_key = db.execute("SELECT count(*) FROM fact WHERE date_rep IS NULL OR load_from IS NULL").scalar()
+        if rows_without_key:
+            raise RuntimeError(
+                f"Table fact has {rows_without_key} rows without date_rep or load_from - they are the primary key "
+                f"of the partitioned table (the rows must be fixed or deleted before the migration)"
+            )
+        rows_old, date_min, date_max = db.execute("SELECT count(*), min(date_rep), max(date_rep) FROM fact").first()
+        db.execute("ALTER TABLE fact RENAME TO fact_old")
+        db.execute("ALTER SEQUENCE IF EXISTS fact_id_seq RENAME TO fact_old_id_seq")
+        for index_name in db.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'fact_old'").scalars():
+            db.execute(f"ALTER INDEX {index_name} RENAME TO {index_name.replace('fact', 'fact_old', 1)}")
+        db.commit()
+        Fact.__table__.create(bind=engine)
+
+        create_fact_partitions(db, date_min, date_max)
+        columns = ", ".join(column.name for column in Fact.__table__.columns)
+        for month in get_months(date_min, date_max):
+            month_end = month + pd.offsets.MonthEnd(0)
+            amount = db.execute(
+                f"INSERT INTO fact ({columns}) SELECT {columns} FROM fact_old "
+                f"WHERE date_rep BETWEEN '{month:%Y-%m-%d}' AND '{month_end:%Y-%m-%d}'"
+            ).rowcount
+            db.commit()
+            print(f"Copied {amount} rows of {month:%Y-%m}")
+        db.execute("SELECT setval('fact_id_seq', coalesce((SELECT max(id) FROM fact_old), 0) + 1, false)")
+        db.commit()
+        rows_new = db.execute("SELECT count(*) FROM fact").scalar()
+        if rows_new != rows_old:
+            raise RuntimeError(f"Copied {rows_new} rows of {rows_old} - table fact_old is kept")
+        db.execute("DROP TABLE fact_old")
+        db.commit()
+        print("Table fact is partitioned")
+    finally:
+        db.close()
+
+
+def create_fact_indexes(engine: Engine):
+    """Creates the indexes of the model Fact which are absent in the existing table."""
+    from app.core.models import Fact
+
+    for index in Fact.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+
+if __name__ == "__main__":
+    from app.core.database import EnginePostresql
+
+    migrate_fact_to_partitioned(EnginePostresql)
+    create_fact_indexes(EnginePostresql)
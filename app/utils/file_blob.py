@@ -0,0 +1,85 @@
+"""
+Content-addressed bodies of file_storage: the body is stored once in "file_blob" by its SHA-256
+(the same workbook uploaded again is only one more reference), the payloads which are not compressed yet
+(pickle, csv...) are compressed by zstd if the package "zstandard" is installed.
+"""
+import hashlib
+from collections.abc import Iterable, Iterator
+from typing import BinaryIO, Optional
+
+try:
+    import zstandard
+except ImportError:  # the compression is optional - the bodies are stored as is
+    zstandard = None
+
+ZSTD_LEVEL = 3
+# zip (xlsx, docx...), gzip, parquet, zstd, png, jpeg - compression does not help
+COMPRESSED_MAGIC = (b"PK\x03\x04", b"\x1f\x8b", b"PAR1", b"\x28\xb5\x2f\xfd", b"\x89PNG", b"\xff\xd8\xff")
+
+
+def file_body_hash(file_body: bytes) -> str:
+    return hashlib.sha256(file_body).hexdigest()
+
+
+def spool_file_body(chunks: Iterable[bytes], file: BinaryIO) -> tuple[str, int]:
+    """Writes the body given by chunks to file (rewound to the start then), returns (sha256, size)."""
+    body_hash, size = hashlib.sha256(), 0
+    for chunk in chunks:
+        body_hash.update(chunk)
+        size += len(chunk)
+        file.write(chunk)
+    file.seek(0)
+    return body_hash.hexdigest(), size
+
+
+def compress_file_stream(source: BinaryIO, target: BinaryIO, size: int) -> Optional[str]:
+    """
+    The same as compress_file_body for the files: the compressed body is written to target (both files are
+    rewound to the start then), returns the compression - None if the body must be stored from source as is.
+    """
+    is_compressed = source.read(max(len(el) for el in COMPRESSED_MAGIC)).startswith(COMPRESSED_MAGIC)
+    source.seek(0)
+    if zstandard is None or is_compressed:
+        return None
+    # size - the frame keeps the size of the body (decompress_file_body needs it)
+    zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(source, target, size=size)
+    is_smaller = target.tell() < size
+    source.seek(0)
+    target.seek(0)
+    return "zstd" if is_smaller else None
+
+
+def compress_file_body(file_body: bytes) -> tuple[bytes, Optional[str]]:
+    """Returns (stored body, compression) - compression is None if the body is stored as is."""
+    if zstandard is None or file_body.startswith(COMPRESSED_MAGIC):
+        return file_body, None
+    compressed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(file_body)
+    if len(compressed) >= len(file_body):
+        return file_body, None
+    return compressed, "zstd"
+
+
+def decompress_file_body(stored_body: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return bytes(stored_body)
+    if compression != "zstd":
+        raise ValueError(f"Unknown compression of the file body: {compression}")
+    if zstandard is None:
+        raise RuntimeError('The file body is compressed by zstd, the package "zstandard" is required')
+    return zstandard.ZstdDecompressor().decompress(stored_body)
+
+
+def iter_decompressed_chunks(stored_chunks: Iterable[bytes], compression: Optional[str]) -> Iterator[bytes]:
+    """Decompresses the stored body given by chunks by stream - only the current chunk is held in memory."""
+    if compression is None:
+        yield from (bytes(chunk) for chunk in stored_chunks)
+        return
+    if compression != "zstd":
+        raise ValueError(f"Unknown compression of the file body: {compression}")
+    if zstandard is None:
+        raise RuntimeError('The file body is compressed by zstd, the package "zstandard" is required')
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    for chunk in stored_chunks:
+        body = decompressor.decompress(bytes(chunk))
+        if body:
+            yield body
@@ -0,0 +1,43 @@
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+from starlette.types import Message, Receive, Scope, Send
+
+from app.settings import EXCEL_MEDIA_TYPE
+
+# the payload is already compressed (zip/parquet...) - gzip only spends CPU and breaks Content-Length/Range
+COMPRESSED_MEDIA_TYPES = {
+    EXCEL_MEDIA_TYPE,
+    "application/zip",
+    "application/gzip",
+    "application/vnd.apache.parquet",
+    "application/octet-stream",
+    "image/png",
+    "image/jpeg",
+}
+
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """GZipMiddleware which does not compress already compressed media types and partial (Range) responses."""
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = SelectiveGZipResponder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            await responder(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+
+class SelectiveGZipResponder(GZipResponder):
+    is_passthrough = False
+
+    async def send_with_gzip(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            media_type = headers.get("content-type", "").split(";")[0].strip().lower()
+            self.is_passthrough = (
+                media_type in COMPRESSED_MEDIA_TYPES or "content-encoding" in headers or "content-range" in headers
+            )
+        if self.is_passthrough:
+            await self.send(message)
+        else:
+            await super().send_with_gzip(message)
@@ -6,8 +6,10 @@ from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 from tqdm import tqdm
 
-from app.core.crud import delete_facts
+from app.core.crud import delete_facts, touch_fact_months
 from app.core.models import Fact
+from app.utils.downtime import calc_downtime
+from app.utils.fact_partition import create_fact_partitions
 from app.utils.utils_df import MAPPING_NAME_COGNOS
 from app.utils.utils_os import OsCls
 
@@ -324,6 +326,9 @@ def load_cognos_files(db: Session, engine: Engine, engine_ora: Engine, files_lis
         by="Кол-во пропусков", ascending=False
     )
 
+    # calculate the fact of daily downtime
+    new_report_df["Факт ваг-сут простоя"] = calc_downtime(new_report_df)
+
     new_report_df["Простои Факт, ваг-сут"] = new_report_df["Факт ваг-сут простоя"]
     # new_report_df["Простои Расчётный, ваг-сут"] = None
     new_report_df["Простои Факт ВПС, ваг-сут"] = None
@@ -408,7 +413,9 @@ def load_cognos_files(db: Session, engine: Engine, engine_ora: Engine, files_lis
         else 0
     )
 
+    create_fact_partitions(db, report_df["date_rep"].min(), report_df["date_rep"].max())
     save_df_to_model_via_csv(engine=engine, df=report_df, cols=report_df.columns, model_class=Fact)
+    touch_fact_months(db, report_df["date_rep"].min(), report_df["date_rep"].max())
     # df_to_new_table(db, engine, report_df, table_name="fact_cognos")
     return f"Added {len(report_df.index)} records {deleted_rec}."
 
@@ -752,7 +759,9 @@ def load_sap_files(db: Session, engine: Engine, engine_ora: Engine, files_list:
         else 0
     )
 
+    create_fact_partitions(db, report_df["date_rep"].min(), report_df["date_rep"].max())
     save_df_to_model_via_csv(engine=engine, df=report_df, cols=report_df.columns, model_class=Fact)
+    touch_fact_months(db, report_df["date_rep"].min(), report_df["date_rep"].max())
     # df_to_new_table(db, engine, report_df, table_name="fact_sap")
     return f"Added {len(report_df.index)} records {deleted_rec}."
 
@@ -1,15 +1,45 @@
-from datetime import timedelta
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+from multiprocessing import get_context
 from pathlib import Path
+from threading import Event, Thread
+from typing import Callable, Optional
 
 import pandas as pd
 from fastapi import UploadFile
 from pandas import DataFrame
+from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
-from app.core.crud import create_season_coefficient, create_season_coefficient_body_list, delete_facts
+from app.core.crud import (
+    create_season_coefficient,
+    create_season_coefficient_body_list,
+    delete_facts,
+    finish_load_job,
+    get_load_job,
+    get_load_job_spool_path,
+    heartbeat_load_job,
+    set_load_job_status,
+    touch_fact_months,
+    update_load_job_file,
+    write_log,
+)
+from app.core.database import SessionLocal
 from app.core.models import Fact
 from app.core.schemas import SeasonCoefficientBodyCreate, SeasonCoefficientCreate
+from app.settings import PARSED_CONFIG, LoadJobStateEnum, MyLogTypeEnum
+from app.utils.downtime import calc_downtime
+from app.utils.fact_partition import (
+    create_fact_partitions,
+    create_fact_staging,
+    drop_fact_staging,
+    overwrite_fact_partitions,
+    replace_fact_from_staging,
+    validate_fact_staging,
+)
 from app.utils.utils import read_excel_with_find_headers, save_df_to_model_via_csv, save_df_with_unique
 from app.utils.utils_df import MAPPING_NAME_COGNOS, MAPPING_SEASONAL_COEFFICIENT
 from app.utils.utils_os import OsCls
@@ -65,7 +95,9 @@ def load_fact_from_pickle(db: Session, engine: Engine):
     report_df.rename(columns=columns_for_rename, inplace=True)
     print(f"Finished concat DF ({report_df.shape[0]} rows)\nStart save in SQL DB")
 
+    create_fact_partitions(db, report_df["date_rep"].min(), report_df["date_rep"].max())
     save_df_to_model_via_csv(engine=engine, df=report_df, cols=report_df.columns, model_class=Fact)
+    touch_fact_months(db, report_df["date_rep"].min(), report_df["date_rep"].max())
     return {
         "message": f'Added {len(report_df.index)} records (from Cognos {deleted_rec_cognos["message"]}, '
         f'from SAP {deleted_rec_sap["message"]}).'
@@ -74,29 +106,19 @@ def load_fact_from_pickle(db: Session, engine: Engine):
 
 # async def load_cognos_file(         # for single load-cognos-excel
 def load_cognos_file(db: Session, engine: Engine, engine_ora: Engine, uploaded_file: UploadFile, is_overwrite=True):
-    def calc_downtime(row):
-        if row["Сдвоенная операция"] != "да":
-            result = (row["Дата приема след."] - row["Дата прибытия тек."]).total_seconds() / timedelta(
-                days=1
-            ).total_seconds()
-        elif row["Ваг-сут простоя для сдвоенных"] > 0:
-            result = (
-                (
-                    (row["Дата приема след."] - row["Дата прибытия тек."]).total_seconds()
-                    / timedelta(days=1).total_seconds()
-                )
-                / row["Ваг-сут простоя для сдвоенных"]
-                * row["Факт ваг-сут простоя"]
-            )
-        else:
-            result = row["Факт ваг-сут простоя"]
-        return round(result, 6)
-
     content = uploaded_file.read()  # async read
     # content = await uploaded_file.read()    # for single load-cognos-excel
-    report_df = pd.read_excel(
+    report_df = prepare_cognos_df(engine, engine_ora, content)
+    return save_fact_df(db, engine, report_df, "Cognos", is_overwrite)
+
+
+def prepare_cognos_df(
+    engine: Engine, engine_ora: Engine, content: bytes, progress: Optional[Callable] = None
+) -> DataFrame:
+    """Reads, cleans and enriches the report of Cognos - the rows of Fact are returned, nothing is written to DB."""
+    report_df = read_excel_with_find_headers(
         content,
-        usecols=[
+        headers_list=[
             "Отчетная дата",
             "Код станции ГО",
             "Станция выполнения ГО",
@@ -121,6 +143,8 @@ def load_cognos_file(db: Session, engine: Engine, engine_ora: Engine, uploaded_f
     report_df.columns = report_df.columns.str.strip()
     print(report_df.shape)
     print(report_df.head(5))
+    if progress:
+        progress("parsed", report_df.shape[0])
 
     # Обработка "Код станции ГО"
     report_df.loc[report_df["Код станции ГО"].notnull(), "Код станции ГО"] = report_df.loc[
@@ -318,7 +342,7 @@ def load_cognos_file(db: Session, engine: Engine, engine_ora: Engine, uploaded_f
 
     # calculate the fact of daily downtime
 
-    report_df["Факт ваг-сут простоя"] = report_df.apply(calc_downtime, axis=1)
+    report_df["Факт ваг-сут простоя"] = calc_downtime(report_df)
 
     # report_df["Простои Факт, ваг-сут"] = report_df["Факт ваг-сут простоя"]
     # report_df["Простои Расчётный, ваг-сут"] = None
@@ -382,27 +406,303 @@ def load_cognos_file(db: Session, engine: Engine, engine_ora: Engine, uploaded_f
     report_df["load_from"] = "Cognos"
     report_df = add_info_by_station_cod(engine_ora, report_df)
 
-    # delete previously uploaded records from this period
-    deleted_rec = (
-        delete_facts(
-            db=db, date_min=report_df["date_rep"].min(), date_max=report_df["date_rep"].max(), load_from="Cognos"
-        )
-        if is_overwrite
-        else 0
-    )
-
     # report_columns = ['date_rep', 'load_from', 'st_code', 'org_id', 'sender_cod', 'receiver_cod', 'client_sap_id',
     #                   'type_op', 'wagon_num', 'rps_short', 'cargo_group_num', 'double_operation', 'parking_fact']
     # report_columns = ['date_rep', 'load_from', 'st_code', 'org_id', 'client_sap_id',
     #                   'type_op', 'wagon_num', 'rps_short', 'cargo_group_num', 'parking_fact']
     report_df.drop("id", axis=1, inplace=True)
     # report_df = report_df[report_columns]
-    save_df_to_model_via_csv(engine=engine, df=report_df, cols=report_df.columns, model_class=Fact)
     # df_to_new_table(db, engine, report_df, table_name="fact_cognos")
-    return f"Added {len(report_df.index)} records {deleted_rec}."
+    if progress:
+        progress("enriched", report_df.shape[0])
+    return report_df
+
+
+def save_fact_df(db: Session, engine: Engine, report_df: DataFrame, load_from: str, is_overwrite=True) -> str:
+    deleted_rec = save_fact_df_list(db, engine, [report_df], load_from, is_overwrite)
+    return f"Added {len(report_df.index)} records (removed {deleted_rec} records)."
+
+
+def save_fact_df_list(
+    db: Session,
+    engine: Engine,
+    df_list: list[DataFrame],
+    load_from: str,
+    is_overwrite=True,
+    progress_list: Optional[list[Callable]] = None,
+) -> int:
+    """
+    Writes the facts of load_from, returns the amount of the removed records (is_overwrite - the periods of the frames
+    are replaced). With FACT_OVERWRITE_STAGING the frames are copied into the unlogged staging table, checked and
+    the periods are replaced in one transaction, otherwise the periods are removed before the COPY.
+    The coverage is recounted once for each merged period.
+    """
+    progress_list = progress_list or [None] * len(df_list)
+    periods = merge_periods([(df["date_rep"].min(), df["date_rep"].max()) for df in df_list if df.shape[0]])
+    if not periods:
+        return 0
+    if is_overwrite and PARSED_CONFIG.FACT_OVERWRITE_STAGING:
+        staging = create_fact_staging(db)
+        try:
+            for report_df, progress in zip(df_list, progress_list):
+                _copy_fact_df(engine, report_df, progress, staging)
+            return save_fact_staging(db, staging, sum(df.shape[0] for df in df_list), periods, load_from)
+        finally:
+            drop_fact_staging(db, staging)
+
+    create_fact_partitions(db, periods[0][0], periods[-1][1])
+    # delete previously uploaded records from this period
+    deleted_rec = 0
+    if is_overwrite:
+        for date_min, date_max in periods:
+            deleted_rec += overwrite_fact_partitions(db, date_min, date_max, load_from)
+    for report_df, progress in zip(df_list, progress_list):
+        _copy_fact_df(engine, report_df, progress)
+    for date_min, date_max in periods:
+        touch_fact_months(db, date_min, date_max)
+    return deleted_rec
+
+
+def save_fact_staging(
+    db: Session, staging: str, rows: int, periods: list[tuple], load_from: str, is_overwrite=True
+) -> int:
+    """
+    Moves the facts of load_from from the filled staging table into fact, returns the amount of the removed records
+    (is_overwrite - the periods are replaced: with FACT_OVERWRITE_STAGING in one transaction, otherwise they are
+    removed before the insert). The coverage is recounted once for each merged period.
+    """
+    if not periods:
+        return 0
+    create_fact_partitions(db, periods[0][0], periods[-1][1])
+    validate_fact_staging(db, staging, rows, periods, load_from)
+    if is_overwrite and PARSED_CONFIG.FACT_OVERWRITE_STAGING:
+        deleted_rec = replace_fact_from_staging(db, staging, periods, load_from)
+    else:
+        deleted_rec = 0
+        if is_overwrite:
+            for date_min, date_max in periods:
+                deleted_rec += overwrite_fact_partitions(db, date_min, date_max, load_from)
+        columns = ", ".join(column.name for column in Fact.__table__.columns)
+        db.execute(f"INSERT INTO fact ({columns}) SELECT {columns} FROM {staging}")
+        db.commit()
+    for date_min, date_max in periods:
+        touch_fact_months(db, date_min, date_max)
+    return deleted_rec
+
+
+def _copy_fact_df(engine: Engine, report_df: DataFrame, progress: Optional[Callable] = None, db_table: str = None):
+    if progress:
+        progress("copying")
+    save_df_to_model_via_csv(engine=engine, df=report_df, cols=report_df.columns, model_class=Fact, db_table=db_table)
+    if progress:
+        progress("copied", report_df.shape[0])
 
 
 def load_sap_file(db: Session, engine: Engine, engine_ora: Engine, uploaded_file: UploadFile, is_overwrite=True):
+    content = uploaded_file.read()  # async read
+    report_df = prepare_sap_df(engine, engine_ora, content)
+    result_spr = add_sap_client_in_spr(db, engine, report_df)
+    print(f"Обновление справочников({result_spr})")
+    result = save_fact_df(db, engine, report_df, "SAP", is_overwrite)
+    return f"{result}. Обновление справочников ({result_spr})."
+
+
+def load_fact_files(
+    db: Session,
+    engine: Engine,
+    engine_ora: Engine,
+    files: list[tuple[str, str]],
+    load_from: str,
+    is_overwrite=True,
+    workers: Optional[int] = None,
+    progress_list: Optional[list[Callable]] = None,
+) -> list[str]:
+    """
+    Loads several reports of load_from ("Cognos" or "SAP"), files - [(file name, path of the spooled file)].
+    The files are read and cleaned in the pool of processes (each process has its own connections), each file
+    is copied into the unlogged staging table by its process as soon as it is read (the frames of all files are not
+    held in memory), then the facts of all files are moved into fact in one step by save_fact_staging (the files
+    of the same period do not remove each other), the coverage is recounted once in the end.
+    progress_list - progress(stage, rows) for each file (picklable, it is called in the processes of the pool too).
+    """
+    workers = workers or PARSED_CONFIG.FACT_LOAD_WORKERS
+    path_list = [file_path for _, file_path in files]
+    progress_list = progress_list or [None] * len(files)
+    staging = create_fact_staging(db)
+    try:
+        if workers > 1 and len(files) > 1:
+            print(f"load_fact_files: {len(files)} files of {load_from} on {min(workers, len(files))} processes")
+            with ProcessPoolExecutor(max_workers=min(workers, len(files)), mp_context=get_context("spawn")) as executor:
+                summary_list = list(
+                    executor.map(_stage_fact_file, repeat(load_from), path_list, repeat(staging), progress_list)
+                )
+        else:
+            summary_list = [
+                _stage_fact_df(engine, engine_ora, load_from, file_path, staging, progress)
+                for file_path, progress in zip(path_list, progress_list)
+            ]
+
+        result_spr = None
+        if load_from == "SAP":
+            result_spr = add_sap_client_in_spr(db, engine, pd.concat([clients for _, _, clients in summary_list]))
+            print(f"Обновление справочников({result_spr})")
+
+        periods = merge_periods([period for _, period, _ in summary_list if period])
+        rows = sum(rows for rows, _, _ in summary_list)
+        deleted_rec = save_fact_staging(db, staging, rows, periods, load_from, is_overwrite)
+    finally:
+        drop_fact_staging(db, staging)
+    result = []
+    for (name, _), (rows, _, _) in zip(files, summary_list):
+        message = f"Added {rows} records (removed {deleted_rec} records in the periods of all files)."
+        print(f'"{name}": {message}')
+        result.append(message if result_spr is None else f"{message} Обновление справочников ({result_spr}).")
+    return result
+
+
+def merge_periods(periods: list[tuple]) -> list[tuple]:
+    """Merges the intersecting and adjacent periods [(date_min, date_max), ...]."""
+    merged = []
+    for date_min, date_max in sorted(periods):
+        if merged and date_min <= merged[-1][1] + pd.Timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], date_max))
+        else:
+            merged.append((date_min, date_max))
+    return merged
+
+
+def _prepare_fact_df(
+    engine: Engine, engine_ora: Engine, load_from: str, content: bytes, progress: Optional[Callable] = None
+) -> DataFrame:
+    if progress:
+        progress("parsing")
+    prepare = prepare_sap_df if load_from == "SAP" else prepare_cognos_df
+    return prepare(engine, engine_ora, content, progress)
+
+
+def _stage_fact_df(
+    engine: Engine,
+    engine_ora: Engine,
+    load_from: str,
+    file_path: str,
+    staging: str,
+    progress: Optional[Callable] = None,
+) -> tuple[int, Optional[tuple], Optional[DataFrame]]:
+    """
+    Reads the file and copies its facts into the staging table at once, returns only the summary:
+    (rows, (date_min, date_max) or None, the pairs client_sap_id/client of SAP or None).
+    """
+    report_df = _prepare_fact_df(engine, engine_ora, load_from, Path(file_path).read_bytes(), progress)
+    _copy_fact_df(engine, report_df, progress, staging)
+    period = (report_df["date_rep"].min(), report_df["date_rep"].max()) if report_df.shape[0] else None
+    clients = report_df[["client_sap_id", "client"]].drop_duplicates() if load_from == "SAP" else None
+    return report_df.shape[0], period, clients
+
+
+def _stage_fact_file(
+    load_from: str, file_path: str, staging: str, progress: Optional[Callable] = None
+) -> tuple[int, Optional[tuple], Optional[DataFrame]]:
+    # it is executed in the separate process - the own connections to Postgres and Oracle
+    engine = create_engine(PARSED_CONFIG.database.dsn)
+    engine_ora = create_engine(PARSED_CONFIG.database_ora.dsn, pool_pre_ping=True)
+    try:
+        return _stage_fact_df(engine, engine_ora, load_from, file_path, staging, progress)
+    finally:
+        engine.dispose()
+        engine_ora.dispose()
+
+
+def process_load_job(db: Session, engine: Engine, engine_ora: Engine, load_job_id: int):
+    """
+    Executes the load job (see crud.create_load_job): the spooled files are loaded by load_fact_files,
+    the stages of each file are written into load_job_file, the result/error - into the log of the job.
+    The spooled files are removed after the successful load only (the failed job can be repeated by retry_load_job).
+    """
+    db_load_job = get_load_job(db, load_job_id)
+    username = db_load_job.username
+    set_load_job_status(db, load_job_id, LoadJobStateEnum.in_process)
+    write_log(
+        db=db,
+        parent_id=load_job_id,
+        parent_name="load_job",
+        type=MyLogTypeEnum.START,
+        msg=f"Started the load of {len(db_load_job.file_list)} files of {db_load_job.load_from}",
+        username=username,
+    )
+    exitcode = 0
+    # the stages of the files are written seldom (the parse of a big file takes minutes) - the job is confirmed
+    # alive by the thread, otherwise recover_stale_load_job takes it for lost
+    is_finished = Event()
+    Thread(target=heartbeat_load_job_background, args=(load_job_id, is_finished), daemon=True).start()
+    try:
+        files = [(db_file.file_name, db_file.file_path) for db_file in db_load_job.file_list]
+        progress_list = [partial(report_load_job_progress, db_file.id) for db_file in db_load_job.file_list]
+        result = load_fact_files(
+            db,
+            engine,
+            engine_ora,
+            files,
+            db_load_job.load_from,
+            db_load_job.is_overwrite,
+            progress_list=progress_list,
+        )
+        set_load_job_status(db, load_job_id, LoadJobStateEnum.done)
+        msg = "\n".join(f'"{name}": {message}' for (name, _), message in zip(files, result))
+        write_log(db=db, parent_id=load_job_id, parent_name="load_job", msg=msg, username=username)
+        shutil.rmtree(get_load_job_spool_path(load_job_id), ignore_errors=True)
+    except Exception as err:
+        print(f"load_job {load_job_id}: the load failed ({err!r})")
+        db.rollback()
+        exitcode = 1
+        set_load_job_status(db, load_job_id, LoadJobStateEnum.error)
+        write_log(
+            db=db,
+            parent_id=load_job_id,
+            parent_name="load_job",
+            type=MyLogTypeEnum.ERROR,
+            msg=f"The load failed: {getattr(err, 'detail', err)}",
+            username=username,
+        )
+    finally:
+        is_finished.set()
+        finish_load_job(db, load_job_id, exitcode)
+    return exitcode
+
+
+def process_load_job_background(engine: Engine, engine_ora: Engine, load_job_id: int):
+    # the task of BackgroundTasks (LOAD_JOB_QUEUE=False) - the own session (the session of the request is closed)
+    db = SessionLocal()
+    try:
+        process_load_job(db, engine, engine_ora, load_job_id)
+    finally:
+        db.close()
+
+
+def heartbeat_load_job_background(load_job_id: int, is_finished: Event):
+    db = SessionLocal()
+    try:
+        while not is_finished.wait(max(PARSED_CONFIG.LOAD_JOB_QUEUE_STALE_SEC // 10, 1)):
+            heartbeat_load_job(db, [load_job_id])
+    finally:
+        db.close()
+
+
+def report_load_job_progress(load_job_file_id: int, stage: str, rows: Optional[int] = None):
+    # it is called in the processes of the pool too - the short own session
+    db = SessionLocal()
+    try:
+        update_load_job_file(db, load_job_file_id, stage, rows)
+    finally:
+        db.close()
+
+
+def prepare_sap_df(
+    engine: Engine, engine_ora: Engine, content: bytes, progress: Optional[Callable] = None
+) -> DataFrame:
+    """
+    Reads, cleans and enriches the report of SAP - the rows of Fact are returned, nothing is written to DB
+    (the new clients are added to mapping_client_cognos_sap by add_sap_client_in_spr before the save).
+    """
     usecols = [
         "Отчётная дата",
         "Код станции ГО",
@@ -429,10 +729,10 @@ def load_sap_file(db: Session, engine: Engine, engine_ora: Engine, uploaded_file
         "Факт ваг-сут\nпростоя",  # Символ новой строки!
         "Ваг-сут простоя\nдля сдвоенных",  # Символ новой строки!
     ]
-    content = uploaded_file.read()  # async read
-
     report_df = read_excel_with_find_headers(content=content, headers_list=usecols, skip_footer=1)
     report_df.columns = report_df.columns.str.replace("\n", " ").str.strip()
+    if progress:
+        progress("parsed", report_df.shape[0])
 
     print(report_df.shape)
     print(report_df.head(5))
@@ -735,22 +1035,12 @@ def load_sap_file(db: Session, engine: Engine, engine_ora: Engine, uploaded_file
     )
     # report_df['parking_fact'] = report_df['parking_fact'].apply(np.ceil)
 
-    result_spr = add_sap_client_in_spr(db, engine, report_df)
-    print(f"Обновление справочников({result_spr})")
-
     report_df["load_from"] = "SAP"
     print(f"После удаления дублей, осталось {report_df.shape[0]} rows")
-
-    # delete previously uploaded records from this period
-    deleted_rec = (
-        delete_facts(db=db, date_min=report_df["date_rep"].min(), date_max=report_df["date_rep"].max(), load_from="SAP")
-        if is_overwrite
-        else 0
-    )
-
-    save_df_to_model_via_csv(engine=engine, df=report_df, cols=report_df.columns, model_class=Fact)
     # df_to_new_table(db, engine, report_df, table_name="fact_sap")
-    return f"Added {len(report_df.index)} records {deleted_rec}. Обновление справочников ({result_spr})."
+    if progress:
+        progress("enriched", report_df.shape[0])
+    return report_df
 
 
 def add_info_by_station_cod(engine_ora: Engine, df: DataFrame):
@@ -0,0 +1,202 @@
+"""
+Streaming reader of the reports of Cognos/SAP (xlsx or csv/tsv export of the same report).
+xlsx is read by python-calamine if it is installed (the parser in Rust, the cells are kept compactly outside
+python), otherwise by openpyxl in read-only mode (rows are parsed one by one from the sheet xml, the workbook
+is not built in memory). The header row is searched only in the first rows, the data is emitted
+by typed DataFrame chunks with the columns of headers_list.
+"""
+import csv
+import datetime
+import warnings
+from collections import deque
+from collections.abc import Iterable
+from io import BytesIO, StringIO
+from typing import Iterator, Optional
+
+import openpyxl
+import pandas as pd
+from fastapi import HTTPException
+from pandas import DataFrame
+from pandas.io.parsers import TextParser
+
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # the fast reader is optional - openpyxl (read-only) is used
+    CalamineWorkbook = None
+
+ZIP_MAGIC = b"PK\x03\x04"
+CSV_DELIMITERS = ";,\t|"
+REPORT_CHUNK_SIZE = 100000
+
+
+def iter_report_chunks(
+    content: bytes,
+    headers_list: list[str],
+    number_analyzed_rows: int = 20,
+    skip_footer: int = 0,
+    chunk_size: int = REPORT_CHUNK_SIZE,
+) -> Iterator[DataFrame]:
+    """
+    Yields the rows of the report by chunks of chunk_size rows, the columns - headers_list (in this order).
+    The header row is the first of number_analyzed_rows rows which contains all headers_list,
+    the last skip_footer rows (totals) are skipped.
+    """
+    headers_list = list(dict.fromkeys(headers_list))
+    if content[:4] == ZIP_MAGIC:
+        yield from _iter_xlsx_chunks(content, headers_list, number_analyzed_rows, skip_footer, chunk_size)
+    else:
+        yield from _iter_csv_chunks(content, headers_list, number_analyzed_rows, skip_footer, chunk_size)
+
+
+def read_report(
+    content: bytes, headers_list: list[str], number_analyzed_rows: int = 20, skip_footer: int = 0
+) -> DataFrame:
+    chunks = list(iter_report_chunks(content, headers_list, number_analyzed_rows, skip_footer))
+    if not chunks:
+        return DataFrame(columns=list(dict.fromkeys(headers_list)))
+    return pd.concat(chunks, ignore_index=True)
+
+
+def find_header_row(rows: Iterable[tuple], headers_list: list[str], number_analyzed_rows: int) -> tuple[int, list]:
+    """Returns (number of the header row, positions of headers_list in it)."""
+    for num_row, row in enumerate(rows):
+        if num_row >= number_analyzed_rows:
+            break
+        values = ["" if value is None else str(value) for value in row]
+        if all(header in values for header in headers_list):
+            return num_row, [values.index(header) for header in headers_list]
+    raise HTTPException(status_code=422, detail=f"The full list of headers was not found in the file: ({headers_list})")
+
+
+def _iter_xlsx_chunks(
+    content: bytes, headers_list: list[str], number_analyzed_rows: int, skip_footer: int, chunk_size: int
+) -> Iterator[DataFrame]:
+    if CalamineWorkbook is not None:
+        workbook = CalamineWorkbook.from_filelike(BytesIO(content))
+        rows = workbook.get_sheet_by_index(0).iter_rows()
+        _, positions = find_header_row(rows, headers_list, number_analyzed_rows)
+        data_rows = ([_convert_cell(row[pos] if pos < len(row) else None) for pos in positions] for row in rows)
+        yield from _iter_row_chunks(data_rows, headers_list, skip_footer, chunk_size)
+        return
+
+    with warnings.catch_warnings(record=True):
+        warnings.simplefilter("always")  # for remove warn: "Workbook contains no default style, ..."
+        workbook = openpyxl.load_workbook(BytesIO(content), read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        _, positions = find_header_row(rows, headers_list, number_analyzed_rows)
+        data_rows = ([_convert_cell(row[pos] if pos < len(row) else None) for pos in positions] for row in rows)
+        yield from _iter_row_chunks(data_rows, headers_list, skip_footer, chunk_size)
+    finally:
+        workbook.close()
+
+
+def _convert_cell(value):
+    # the same conversion as pd.read_excel (openpyxl): integer floats -> int, empty -> ""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if type(value) is datetime.date:
+        return datetime.datetime.combine(value, datetime.time())  # calamine returns date for 00:00
+    return value
+
+
+def _iter_row_chunks(
+    data_rows: Iterable[list], headers_list: list[str], skip_footer: int, chunk_size: int
+) -> Iterator[DataFrame]:
+    chunk, empty_rows = [], []
+    footer = deque()
+    for row in data_rows:
+        if all(value == "" for value in row):
+            # the empty rows at the end of the sheet are dropped (as pd.read_excel does)
+            empty_rows.append(row)
+            continue
+        for row_ in empty_rows + [row]:
+            footer.append(row_)
+            if len(footer) > skip_footer:
+                chunk.append(footer.popleft())
+        empty_rows = []
+        if len(chunk) >= chunk_size:
+            yield _rows_to_df(chunk, headers_list)
+            chunk = []
+    if chunk:
+        yield _rows_to_df(chunk, headers_list)
+
+
+def _rows_to_df(rows: list[list], headers_list: list[str]) -> DataFrame:
+    # the parser of pd.read_excel: na_values, conversion of numeric strings, dates -> datetime64
+    return TextParser(rows, names=headers_list, header=None).read()
+
+
+def _iter_csv_chunks(
+    content: bytes, headers_list: list[str], number_analyzed_rows: int, skip_footer: int, chunk_size: int
+) -> Iterator[DataFrame]:
+    encoding = _detect_encoding(content)
+    head = content[: 256 * 1024].decode(encoding, errors="ignore")
+    delimiter, header_row = _find_csv_header_row(head, headers_list, number_analyzed_rows)
+    date_columns = [header for header in headers_list if "дата" in header.lower()]
+    reader = pd.read_csv(
+        BytesIO(content),
+        sep=delimiter,
+        encoding=encoding,
+        skiprows=header_row,
+        usecols=headers_list,
+        decimal="," if delimiter == ";" else ".",
+        chunksize=chunk_size,
+        skip_blank_lines=True,
+    )
+    # the footer is cut from the last chunk - the chunks are emitted with the lag of one chunk
+    previous: Optional[DataFrame] = None
+    for df in reader:
+        if previous is not None:
+            if skip_footer and df.shape[0] < skip_footer:
+                df = pd.concat([previous, df], ignore_index=True)
+            else:
+                yield _parse_dates(previous[headers_list], date_columns)
+        previous = df
+    if previous is not None:
+        previous = previous.iloc[: previous.shape[0] - skip_footer] if skip_footer else previous
+        if previous.shape[0]:
+            yield _parse_dates(previous[headers_list], date_columns)
+
+
+def _find_csv_header_row(head: str, headers_list: list[str], number_analyzed_rows: int) -> tuple[str, int]:
+    """
+    Returns (delimiter, number of the header row): the delimiter is the first of CSV_DELIMITERS which splits
+    one of the first number_analyzed_rows lines into all headers_list (not sniffed by the title lines).
+    """
+    for delimiter in CSV_DELIMITERS:
+        rows = (
+            [value.strip("\r") for value in row] for row in csv.reader(StringIO(head, newline=""), delimiter=delimiter)
+        )
+        try:
+            return delimiter, find_header_row(rows, headers_list, number_analyzed_rows)[0]
+        except HTTPException:
+            continue
+    raise HTTPException(status_code=422, detail=f"The full list of headers was not found in the file: ({headers_list})")
+
+
+def _parse_dates(df: DataFrame, date_columns: list[str]) -> DataFrame:
+    # the dates of the export are "dd.mm.yyyy[ hh:mm]", the column with other values is left as is
+    for col in date_columns:
+        if df[col].dtype == object or df[col].isnull().all():
+            try:
+                df[col] = pd.to_datetime(df[col], dayfirst=True)
+            except (ValueError, TypeError):
+                pass
+    return df
+
+
+def _detect_encoding(content: bytes) -> str:
+    # the exports of Cognos/SAP are utf-8 or windows-1251 (chardet is mistaken on the sample of dates and numbers)
+    if content[:3] == b"\xef\xbb\xbf":
+        return "utf-8-sig"
+    sample = content[: 256 * 1024]
+    try:
+        sample.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError as err:
+        if err.start >= len(sample) - 3:
+            return "utf-8"  # the sample is cut in the middle of the multibyte symbol
+        return "cp1251"
@@ -1,25 +1,34 @@
+import csv
 import logging
 import sys
 import warnings
 from collections.abc import Mapping
 from enum import Enum
 from functools import wraps
-from io import BytesIO, StringIO
+from io import BytesIO
 from pathlib import Path
-from time import process_time
-from typing import Optional
+from tempfile import TemporaryDirectory, TemporaryFile
+from time import perf_counter, process_time
+from typing import Iterator, Optional
 
 import numpy as np
 import pandas as pd
+import xlsxwriter
 import yaml
 from fastapi import HTTPException
 from pandas import DataFrame, ExcelWriter
+from sqlalchemy import types as sa_types
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import Session
 
+from app.utils.report_reader import read_report
 from app.utils.utils_df import MAPPING_NAME_COGNOS
 
 
+COPY_BATCH_ROWS = 50000
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
 def read_yaml(path: Path) -> Mapping:
     with open(path, encoding="utf-8") as file:
         return yaml.safe_load(file)
@@ -113,6 +122,50 @@ def table_writer(dataframes: dict[Optional[str], DataFrame], param: Optional = "
     return output
 
 
+def table_writer_stream(
+    dataframes: dict[Optional[str], DataFrame], param: Optional = "xlsx", chunk_size: int = 1024 * 1024
+) -> Iterator[bytes]:
+    """
+    The same files as table_writer, but the rows are written straight to a temporary file
+    (xlsxwriter "constant_memory" - one row in memory), then the file is yielded by chunks (for StreamingResponse).
+    """
+    with TemporaryDirectory() as temp_dir:
+        file_name = Path(temp_dir, f"table.{param}")
+        if param == "xlsx":
+            write_xlsx_constant_memory(dataframes, file_name)
+        elif param == "csv":
+            with open(file_name, "w", encoding="utf-8", newline="") as file:
+                for dataframe in dataframes.values():
+                    dataframe.to_csv(file, index=False)
+        else:
+            raise HTTPException(status_code=400, detail="file type not allowed")
+        with open(file_name, "rb") as file:
+            while chunk := file.read(chunk_size):
+                yield chunk
+
+
+def write_xlsx_constant_memory(dataframes: dict[Optional[str], DataFrame], file_name, rows_in_batch: int = 10000):
+    workbook = xlsxwriter.Workbook(
+        str(file_name),
+        {"constant_memory": True, "default_date_format": "yyyy-mm-dd"},
+    )
+    header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    for name, dataframe in dataframes.items():
+        worksheet = workbook.add_worksheet(name if name else "sheet 1")
+        worksheet.write_row(0, 0, [str(el) for el in dataframe.columns], header_format)
+        row_num = 1
+        # in "constant_memory" mode the rows must be written strictly one after another
+        for start in range(0, dataframe.shape[0], rows_in_batch):
+            values = dataframe.iloc[start : start + rows_in_batch].to_numpy(dtype=object)
+            # the same as DataFrame.to_excel: NaN/NaT - empty cell, inf - "inf"
+            values[pd.isna(values)] = None
+            values[values == np.inf], values[values == -np.inf] = "inf", "-inf"
+            for row in values.tolist():
+                worksheet.write_row(row_num, 0, row)
+                row_num += 1
+    workbook.close()
+
+
 def df_to_new_table(db: Session, engine: Engine, df, table_name, is_cast_uppercase=False):
     # def load_csv_into_new_table(file, db_schema, db_table, db_name='default',
     #                             is_cast_uppercase=False, delimeter='|', encoding='utf-8', decimal='.'):
@@ -172,37 +225,97 @@ def df_to_new_table(db: Session, engine: Engine, df, table_name, is_cast_upperca
     print("done!")
 
 
-def save_df_to_model_via_csv(engine: Engine, df, cols=None, model_class=None, db_table=None):
-    # fastest way to insert into model raw data via CSV file
+def save_df_to_model_via_csv(
+    engine: Engine, df, cols=None, model_class=None, db_table=None, batch_rows: int = COPY_BATCH_ROWS
+) -> int:
+    """
+    Fastest way to insert raw data into the model: COPY ... FROM STDIN (text format).
+    The rows are rendered by batches of batch_rows and streamed to the server, so only one batch is kept
+    as text in memory. The strings longer than VARCHAR of the model are cut, df is not changed.
+    db_table with model_class - the table of the same structure (the staging of the model).
+    One commit, the connection is returned into the pool. Returns the amount of the rows.
+    """
     assert model_class or db_table, "model_class or db_table should be provided"
     if df.empty:
-        return
-    cols = df.columns if cols is None else cols
+        return 0
+    cols = list(df.columns if cols is None else cols)
+    varchar_len = {}
     if model_class:
-        db_table = model_class.__tablename__
+        db_table = db_table or model_class.__tablename__
         cols_from_model = set(map(lambda x: str(x).split(".")[-1], model_class.__table__.columns))
-        cols = list(cols_from_model.intersection(cols))
-
-        for col in cols:
-            if str(model_class.__dict__[col].type).startswith("VARCHAR("):
-                df.loc[df[col].isnull(), col] = ""
-                # df[col].fillna("", inplace=True)
-                max_len_db_col = model_class.__dict__[col].type.length
-                max_len_df_col = max(df[col].apply(str).apply(len))
-                if max_len_df_col > max_len_db_col:
-                    df[col] = df[col].str.slice(0, max_len_db_col - 1)
-                    print(f"{col} max len ={max_len_df_col}")
-
-    output = StringIO()
-    # import csv
-    df[cols].to_csv(output, sep="\t", header=False, index=False, quotechar="&")  # , quoting=csv.QUOTE_MINIMAL)
-    # df[cols].to_csv(output, sep="\t", header=False, index=False)
-    output.seek(0)
-    contents = output.getvalue()
-    fake_conn = engine.raw_connection()
-    fake_cur = fake_conn.cursor()
-    fake_cur.copy_from(output, db_table, null="", columns=cols)
-    fake_conn.commit()
+        cols = [col for col in cols if col in cols_from_model]
+        varchar_len = {
+            col: model_class.__dict__[col].type.length
+            for col in cols
+            if str(model_class.__dict__[col].type).startswith("VARCHAR(")
+        }
+
+    batches = (
+        render_copy_batch(df.iloc[start : start + batch_rows], cols, varchar_len)
+        for start in range(0, df.shape[0], batch_rows)
+    )
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {db_table} ({', '.join(cols)}) FROM STDIN WITH (FORMAT text, NULL '')",
+                IteratorFile(batches),
+                size=COPY_BUFFER_SIZE,
+            )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()  # returns the connection into the pool
+    return df.shape[0]
+
+
+def render_copy_batch(df: DataFrame, cols: list, varchar_len: Optional[dict] = None) -> str:
+    """
+    Rows of df[cols] in the text format of COPY: tab separated, empty - NULL, the tab/newline/backslash
+    in the values are escaped by backslash (lines end with \\r\\n - so the carriage return is escaped too).
+    """
+    df = df[cols]
+    for col, max_len in (varchar_len or {}).items():
+        text = df[col].astype(str).mask(df[col].isnull())
+        max_len_df_col = text.str.len().max()
+        if max_len_df_col > max_len:
+            print(f"{col} max len ={max_len_df_col} (cut to {max_len})")
+            df = df.assign(**{col: text.str.slice(0, max_len)})
+    if len(cols) == 1:
+        # csv does not write the record of one empty field without quotes
+        df = df.assign(_empty="")
+    text = df.to_csv(
+        sep="\t", header=False, index=False, quoting=csv.QUOTE_NONE, escapechar="\\", lineterminator="\r\n"
+    )
+    return text.replace("\t\r\n", "\r\n") if len(cols) == 1 else text
+
+
+class IteratorFile:
+    """Read-only file-like object over the iterator of strings (for cursor.copy_expert)."""
+
+    def __init__(self, iterator: Iterator[str]):
+        self._iterator = iterator
+        self._chunk = ""
+        self._position = 0
+
+    def read(self, size: int = -1) -> str:
+        while self._position >= len(self._chunk):
+            self._chunk, self._position = next(self._iterator, None), 0
+            if self._chunk is None:
+                self._chunk = ""
+                return ""
+        if size is None or size < 0:
+            result = self._chunk[self._position :] + "".join(self._iterator)
+            self._chunk, self._position = "", 0
+            return result
+        result = self._chunk[self._position : self._position + size]
+        self._position += len(result)
+        return result
+
+    def readline(self, size: int = -1) -> str:
+        return self.read(size)
 
 
 def save_df_with_unique(
@@ -273,11 +386,11 @@ def find_headers_row(
 def read_excel_with_find_headers(
     content, headers_list: list[str], number_analyzed_rows: int = 20, skip_footer: int = 0
 ):
-    return find_headers_row(
+    # streaming reader (xlsx read-only or csv), the header row is searched in the first number_analyzed_rows rows
+    return read_report(
         content=content,
         headers_list=headers_list,
         number_analyzed_rows=number_analyzed_rows,
-        is_return_df=True,
         skip_footer=skip_footer,
     )
 
@@ -295,25 +408,83 @@ def get_info_from_excel(content):
     return {"rows": report_df.shape[0], "cols": report_df.shape[1]}
 
 
-def read_sql_with_chunk(postgre_eng: Engine, sql_command: str, chunk_size: int = 100000) -> DataFrame:
+def iter_sql_chunks(postgre_eng: Engine, sql_command: str, chunk_size: int = 100000) -> Iterator[DataFrame]:
+    """
+    Streams the result of sql_command by chunks of chunk_size rows.
+    A named (server-side) cursor is used, so Postgres executes the query once and the rows are fetched
+    page by page without "limit/offset" rescans.
+    """
     sys.stdout.write(f'Performing SQL: "{sql_command}"')
-    offset = 0
-    report_df = DataFrame()
-    while True:
-        sql = sql_command + f" limit {chunk_size} offset {offset}"
-        df = pd.read_sql(sql, con=postgre_eng)
-        # df = reduce_mem_usage(df)
-        report_df = pd.concat([report_df, df])
-        offset += chunk_size
-        sys.stdout.write(".")
-        sys.stdout.flush()
-        if df.shape[0] < chunk_size:
-            break
-    report_df.reset_index(drop=True, inplace=True)
+    rows, start_time = 0, perf_counter()
+    with postgre_eng.connect().execution_options(stream_results=True, max_row_buffer=chunk_size) as connection:
+        for df in pd.read_sql(sql_command, con=connection, chunksize=chunk_size):
+            rows += df.shape[0]
+            sys.stdout.write(f" {rows} rows ({rows / max(perf_counter() - start_time, 1e-9):.0f} rows/sec)")
+            sys.stdout.flush()
+            yield df
+    sys.stdout.write("\n")
+
+
+def read_sql_with_chunk(postgre_eng: Engine, sql_command: str, chunk_size: int = 100000) -> DataFrame:
+    chunks = list(iter_sql_chunks(postgre_eng, sql_command, chunk_size))
+    if not chunks:
+        return DataFrame()
+    # one concat at the end instead of copying the accumulated frame on every chunk
+    return pd.concat(chunks, ignore_index=True)
+
+
+def model_read_csv_dtypes(model_class) -> tuple[dict, list]:
+    """
+    dtypes for pd.read_csv by the columns of the SQLAlchemy model:
+    String -> str (the codes keep leading zeros), Numeric -> float64, Date/DateTime -> parse_dates.
+    Integer columns are left for inference (int64, or float64 if there are NULLs - the same as pd.read_sql gives).
+    """
+    dtype, parse_dates = {}, []
+    for column in model_class.__table__.columns:
+        if isinstance(column.type, (sa_types.Date, sa_types.DateTime)):
+            parse_dates.append(column.name)
+        elif isinstance(column.type, sa_types.String):
+            dtype[column.name] = str
+        elif isinstance(column.type, sa_types.Numeric) and not isinstance(column.type, sa_types.Integer):
+            dtype[column.name] = "float64"
+    return dtype, parse_dates
+
+
+def read_sql_via_copy(postgre_eng: Engine, sql_command: str, model_class=None) -> DataFrame:
+    """
+    Reads the result of sql_command by "COPY (...) TO STDOUT" - the rows are not converted into python objects
+    by psycopg2/SQLAlchemy, pandas parses the CSV stream straight into columns.
+    The types of the columns are taken from model_class (see model_read_csv_dtypes), the others are inferred.
+    """
+    sys.stdout.write(f'Performing COPY: "{sql_command}"')
+    start_time = perf_counter()
+    dtype, parse_dates = model_read_csv_dtypes(model_class) if model_class is not None else ({}, [])
+    connection = postgre_eng.raw_connection()
+    try:
+        with TemporaryFile("w+b") as buffer:
+            cursor = connection.cursor()
+            cursor.copy_expert(f"COPY ({sql_command}) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '\\N')", buffer)
+            cursor.close()
+            buffer.seek(0)
+            header = buffer.readline().decode("utf-8").rstrip("\r\n").split(",")
+            buffer.seek(0)
+            report_df = pd.read_csv(
+                buffer,
+                encoding="utf-8",
+                dtype={key: value for key, value in dtype.items() if key in header},
+                parse_dates=[el for el in parse_dates if el in header],
+                na_values=["\\N"],
+                keep_default_na=False,
+                float_precision="round_trip",
+            )
+    finally:
+        connection.close()
+    delta = max(perf_counter() - start_time, 1e-9)
+    sys.stdout.write(f" {report_df.shape[0]} rows ({report_df.shape[0] / delta:.0f} rows/sec)\n")
     return report_df
 
 
-def optimize_memory_usage(df, print_size=True):
+def optimize_memory_usage(df, print_size=True, is_downcast_float=True):
     # Function optimizes memory usage in dataframe.
     # (RU) Функция оптимизации типов в dataframe.
 
@@ -337,7 +508,7 @@ def optimize_memory_usage(df, print_size=True):
                     df[column] = df[column].astype(np.int32)
                 elif column_min > np.iinfo(np.int64).min and column_max < np.iinfo(np.int64).max:
                     df[column] = df[column].astype(np.int64)
-            else:
+            elif is_downcast_float:
                 if column_min > np.finfo(np.float32).min and column_max < np.finfo(np.float32).max:
                     df[column] = df[column].astype(np.float32)
                 else:
@@ -0,0 +1,118 @@
+"""
+Worker of the calculations of the TOU and of the load jobs of Fact.
+Takes the jobs from "calc_tou_queue" (see crud.enqueue_calc_tou) and "load_job" (see crud.create_load_job)
+and executes each of them in its own process with its own sessions, so the API workers are not blocked by pandas
+and a restart of gunicorn does not kill the calculation. Several workers (on several nodes) can serve the same queue
+(the load jobs need LOAD_JOB_SPOOL_DIR shared by the nodes).
+
+Run: python -m app.worker  (or: poetry run worker)
+"""
+import os
+import socket
+import time
+from multiprocessing import get_context
+
+from app.core.crud import (
+    claim_calc_tou_queue,
+    claim_load_job,
+    finish_calc_tou_queue,
+    finish_load_job,
+    heartbeat_calc_tou_queue,
+    heartbeat_load_job,
+    recover_stale_calc_tou_queue,
+    recover_stale_load_job,
+)
+from app.core.database import SessionLocal
+from app.settings import PARSED_CONFIG
+
+
+def run_calc_tou(calc_tou_id: int, username: str):
+    # it is executed in the separate process - the own engines and session
+    from app.core.database import EngineOracle, EnginePostresql
+    from app.utils.calc_tou import calc_tou
+
+    db = SessionLocal()
+    try:
+        calc_tou(db, EnginePostresql, EngineOracle, calc_tou_id, username)
+    finally:
+        db.close()
+
+
+def run_load_job(load_job_id: int):
+    # it is executed in the separate process - the own engines and session
+    from app.core.database import EngineOracle, EnginePostresql
+    from app.utils.load_cognos_sap import process_load_job
+
+    db = SessionLocal()
+    try:
+        process_load_job(db, EnginePostresql, EngineOracle, load_job_id)
+    finally:
+        db.close()
+
+
+def main():
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    context = get_context("spawn")
+    running = {}  # calc_tou_queue.id -> Process
+    running_load = {}  # load_job.id -> Process
+    db = SessionLocal()
+    print(
+        f"Calc TOU worker {worker} started ({PARSED_CONFIG.CALC_TOU_JOB_SLOTS} slots, "
+        f"{PARSED_CONFIG.LOAD_JOB_SLOTS} load slots)"
+    )
+    try:
+        while True:
+            for queue_id, process in list(running.items()):
+                if not process.is_alive():
+                    process.join()
+                    finish_calc_tou_queue(db, queue_id, process.exitcode)
+                    print(f"Job {queue_id} finished (exit code {process.exitcode})")
+                    del running[queue_id]
+            for load_job_id, process in list(running_load.items()):
+                if not process.is_alive():
+                    process.join()
+                    finish_load_job(db, load_job_id, process.exitcode)
+                    print(f"Load job {load_job_id} finished (exit code {process.exitcode})")
+                    del running_load[load_job_id]
+            heartbeat_calc_tou_queue(db, list(running))
+            heartbeat_load_job(db, list(running_load))
+            recover_stale_calc_tou_queue(
+                db, PARSED_CONFIG.CALC_TOU_QUEUE_STALE_SEC, PARSED_CONFIG.CALC_TOU_QUEUE_MAX_ATTEMPT
+            )
+            recover_stale_load_job(db, PARSED_CONFIG.LOAD_JOB_QUEUE_STALE_SEC, PARSED_CONFIG.LOAD_JOB_QUEUE_MAX_ATTEMPT)
+
+            while len(running) < PARSED_CONFIG.CALC_TOU_JOB_SLOTS:
+                db_queue = claim_calc_tou_queue(db, worker)
+                if not db_queue:
+                    break
+                process = context.Process(
+                    target=run_calc_tou,
+                    args=(db_queue.calc_tou_id, db_queue.username),
+                    name=f"calc_tou_{db_queue.calc_tou_id}",
+                )
+                process.start()
+                running[db_queue.id] = process
+                print(f"Job {db_queue.id} started (calc_tou_id={db_queue.calc_tou_id}, pid={process.pid})")
+
+            while PARSED_CONFIG.LOAD_JOB_QUEUE and len(running_load) < PARSED_CONFIG.LOAD_JOB_SLOTS:
+                db_load_job = claim_load_job(db, worker)
+                if not db_load_job:
+                    break
+                process = context.Process(
+                    target=run_load_job, args=(db_load_job.id,), name=f"load_job_{db_load_job.id}"
+                )
+                process.start()
+                running_load[db_load_job.id] = process
+                print(f"Load job {db_load_job.id} started ({db_load_job.load_from}, pid={process.pid})")
+
+            time.sleep(PARSED_CONFIG.CALC_TOU_QUEUE_POLL_SEC)
+    finally:
+        # the jobs without heartbeat are returned to the queue by any other worker (recover_stale_calc_tou_queue)
+        for process in list(running.values()) + list(running_load.values()):
+            process.terminate()
+            process.join()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()